@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Geocoding of addresses with persistent cache and deferred queue.
+
+Save of object without coordinates take them from cache only and put
+object in queue, geocode_queue command ask provider in throttled
+batches and write coordinates back. Provider is class from setting
+GEOCODE_PROVIDER with method geocode(address), which returns list of
+{'lat': ..., 'lon': ...} as Nominatim.
+"""
+import re
+import time
+from datetime import datetime
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.importlib import import_module
+from nnmware.apps.address.models import GeocodeCache, GeocodeQueue
+
+GEOCODE_PROVIDER = getattr(settings, 'GEOCODE_PROVIDER', 'nnmware.core.maps.Geocoder')
+GEOCODE_DEFERRED = getattr(settings, 'GEOCODE_DEFERRED', True)
+GEOCODE_MAX_ATTEMPTS = getattr(settings, 'GEOCODE_MAX_ATTEMPTS', 5)
+
+
+def get_provider():
+    module, name = GEOCODE_PROVIDER.rsplit('.', 1)
+    return getattr(import_module(module), name)()
+
+def normalize_address(address):
+    address = re.sub(r'\s*,\s*', ', ', address.strip().lower())
+    return re.sub(r'\s+', ' ', address)[:255]
+
+def _cached(query):
+    try:
+        return GeocodeCache.objects.get(query=query)
+    except GeocodeCache.DoesNotExist:
+        return None
+
+def _position(cached):
+    if cached.found:
+        return cached.latitude, cached.longitude
+    return None
+
+def geocode_address(address, provider=None, cached_only=False):
+    """
+    Returns (latitude, longitude) or None if address is not found. Answers
+    of provider, including not found, stored in cache. With cached_only
+    provider is not asked and None returned for unknown address too.
+    """
+    query = normalize_address(address)
+    if not query:
+        return None
+    cached = _cached(query)
+    if cached is not None:
+        return _position(cached)
+    if cached_only:
+        return None
+    if provider is None:
+        provider = get_provider()
+    response = provider.geocode(address)
+    if response is None:
+        # Provider is unavailable, ask later
+        raise IOError('Geocoding of %s failed' % query)
+    cached = GeocodeCache(query=query, updated_date=datetime.now())
+    if response:
+        cached.latitude, cached.longitude = float(response[0]['lat']), float(response[0]['lon'])
+        cached.found = True
+    cached.save()
+    return _position(cached)
+
+def fill_position(obj):
+    """
+    Set coordinates of object without them. Returns True if object got
+    coordinates, otherwise object must be queued after save.
+    """
+    try:
+        position = geocode_address(obj.geoaddress(), cached_only=GEOCODE_DEFERRED)
+    except IOError:
+        position = None
+    if position is None:
+        return False
+    obj.latitude, obj.longitude = position
+    return True
+
+def enqueue_geocode(obj):
+    ctype = ContentType.objects.get_for_model(obj)
+    if not GeocodeQueue.objects.filter(content_type=ctype, object_id=obj.pk).exists():
+        GeocodeQueue(content_type=ctype, object_id=obj.pk, created_date=datetime.now()).save()
+
+def process_queue(batch=50, delay=1.0, provider=None):
+    """
+    Geocode up to batch queued objects, provider asked not often than one
+    time in delay seconds. Returns (geocoded, not found, failed)
+    """
+    if provider is None:
+        provider = get_provider()
+    geocoded, not_found, failed = 0, 0, 0
+    last_request = 0
+    for item in GeocodeQueue.objects.select_related('content_type').order_by('created_date')[:batch]:
+        try:
+            obj = item.content_type.get_object_for_this_type(pk=item.object_id)
+        except ObjectDoesNotExist:
+            obj = None
+        if obj is None or obj.latitude or obj.longitude:
+            item.delete()
+            continue
+        address = obj.geoaddress()
+        if _cached(normalize_address(address)) is None:
+            wait = last_request + delay - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            last_request = time.time()
+        try:
+            position = geocode_address(address, provider)
+        except IOError:
+            item.attempts += 1
+            if item.attempts >= GEOCODE_MAX_ATTEMPTS:
+                item.delete()
+            else:
+                item.save()
+            failed += 1
+            continue
+        if position is None:
+            not_found += 1
+        else:
+            obj.latitude, obj.longitude = position
+            obj.save()
+            geocoded += 1
+        item.delete()
+    return geocoded, not_found, failed
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from nnmware.apps.address.geocoding import process_queue
+from nnmware.apps.address.models import GeocodeQueue
+
+class Command(BaseCommand):
+    help = 'Geocode addresses of objects saved without coordinates'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', action='store', type='int', dest='batch', default=50,
+            help='Count of objects in one batch'),
+        make_option('--delay', action='store', type='float', dest='delay', default=1.0,
+            help='Minimal seconds between requests to geocoding provider'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Wait for new addresses when queue is empty'),
+        )
+
+    def handle(self, *args, **options):
+        batch, delay = options['batch'], options['delay']
+        if batch < 1 or delay < 0:
+            raise CommandError('Batch must be positive and delay not negative')
+        while True:
+            if GeocodeQueue.objects.exists():
+                geocoded, not_found, failed = process_queue(batch, delay)
+                self.stdout.write('Geocoded %s, not found %s, failed %s\n' % (geocoded, not_found, failed))
+                if not failed or GeocodeQueue.objects.filter(attempts=0).exists():
+                    continue
+            if not options['loop']:
+                break
+            time.sleep(max(delay, 10))
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation.trans_real import get_language
 from nnmware.core.fields import std_text_field
-from nnmware.core.maps import Geocoder
+from nnmware.apps.address.proximity import geo_cell
 from nnmware.core.abstract import MetaName
 
 class Address(MetaName):
@@ -98,18 +99,15 @@ class City(Address):
         else:
             if City.objects.filter(slug=self.slug).exclude(pk=self.pk).count():
                 self.slug = self.pk
-        if not self.latitude and not self.longitude:
-            self.fill_osm_data()
+        geocode = not self.latitude and not self.longitude and not self.fill_osm_data()
         super(City, self).save(*args, **kwargs)
+        if geocode:
+            from nnmware.apps.address.geocoding import enqueue_geocode
+            enqueue_geocode(self)
 
     def fill_osm_data(self):
-        try:
-            client = Geocoder()
-            response = client.geocode(self.geoaddress())[0]
-            self.longitude = response['lon']
-            self.latitude = response['lat']
-        except :
-            pass
+        from nnmware.apps.address.geocoding import fill_position
+        return fill_position(self)
 
 
 
@@ -119,10 +117,15 @@ class MetaGeo(models.Model):
     city = models.ForeignKey(City, verbose_name=_('City'))
     address = models.CharField(verbose_name=_("Address"), max_length=100, blank=True)
     address_en = models.CharField(verbose_name=_("Address(English)"), max_length=100, blank=True)
+    geocell = models.CharField(verbose_name=_("Grid cell"), max_length=16, blank=True, db_index=True, editable=False)
 
     class Meta:
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(MetaGeo, self).__init__(*args, **kwargs)
+        self._saved_position = (self.__dict__.get('latitude'), self.__dict__.get('longitude'))
+
     def geoaddress(self):
         result = self.address
         addr = result.split(',')
@@ -134,18 +137,20 @@ class MetaGeo(models.Model):
         return u"%s, %s" % (result, self.city)
 
     def fill_osm_data(self):
-        try:
-            client = Geocoder()
-            response = client.geocode(self.geoaddress())[0]
-            self.longitude = response['lon']
-            self.latitude = response['lat']
-        except :
-            pass
+        from nnmware.apps.address.geocoding import fill_position
+        return fill_position(self)
 
     def save(self, *args, **kwargs):
-        if not self.latitude and not self.longitude:
-            self.fill_osm_data()
+        geocode = not self.latitude and not self.longitude and not self.fill_osm_data()
+        self.latitude, self.longitude = float(self.latitude), float(self.longitude)
+        self.geocell = geo_cell(self.latitude, self.longitude)
+        # Receivers of post_save refresh neighbours only for moved objects
+        self.moved = not self.pk or (self.latitude, self.longitude) != self._saved_position
         super(MetaGeo, self).save(*args, **kwargs)
+        self._saved_position = (self.latitude, self.longitude)
+        if geocode:
+            from nnmware.apps.address.geocoding import enqueue_geocode
+            enqueue_geocode(self)
 
     def fulladdress(self):
         return u"%s, %s" % (self.address, self.city)
@@ -210,3 +215,30 @@ class MetaLocation(models.Model):
         verbose_name = _("Location")
         verbose_name_plural = _("Locations")
         abstract = True
+
+
+class GeocodeCache(models.Model):
+    query = models.CharField(verbose_name=_("Normalized address"), max_length=255, unique=True)
+    latitude = models.FloatField(_('Latitude'), default=0.0)
+    longitude = models.FloatField(_('Longitude'), default=0.0)
+    found = models.BooleanField(verbose_name=_("Found"), default=False)
+    updated_date = models.DateTimeField(_("Updated date"), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("Geocoded address")
+        verbose_name_plural = _("Geocoded addresses")
+
+    def __unicode__(self):
+        return self.query
+
+
+class GeocodeQueue(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    created_date = models.DateTimeField(_("Created date"), null=True, blank=True)
+    attempts = models.IntegerField(verbose_name=_("Attempts"), default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+        verbose_name = _("Address in geocoding queue")
+        verbose_name_plural = _("Addresses in geocoding queue")
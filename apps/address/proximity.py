@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Proximity search for MetaGeo models. Candidates selected by grid cell
+column and bounding box, exact distance calculated for candidates only.
+"""
+from math import floor, cos, radians, degrees
+from django.conf import settings
+from django.db.models import Q
+from nnmware.core.maps import RADIUS, distances_from
+
+# Size of grid cell in degrees, 0.1 is about 11 km of latitude
+GEO_CELL_SIZE = getattr(settings, 'GEO_CELL_SIZE', 0.1)
+# With more cells in box candidates selected by box only
+GEO_MAX_CELLS = 400
+
+
+def geo_cell(latitude, longitude):
+    return '%d:%d' % (int(floor(latitude / GEO_CELL_SIZE)), int(floor(longitude / GEO_CELL_SIZE)))
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Returns (min latitude, max latitude, min longitude, max longitude) of circle with radius in km
+    """
+    radius = float(radius)
+    d_lat = degrees(radius / RADIUS)
+    cos_lat = cos(radians(latitude))
+    if cos_lat * RADIUS <= radius:
+        d_long = 180.0
+    else:
+        d_long = min(degrees(radius / (RADIUS * cos_lat)), 180.0)
+    return latitude - d_lat, latitude + d_lat, longitude - d_long, longitude + d_long
+
+def box_cells(box):
+    min_lat, max_lat, min_long, max_long = box
+    lat_range = range(int(floor(min_lat / GEO_CELL_SIZE)), int(floor(max_lat / GEO_CELL_SIZE)) + 1)
+    long_range = range(int(floor(min_long / GEO_CELL_SIZE)), int(floor(max_long / GEO_CELL_SIZE)) + 1)
+    if len(lat_range) * len(long_range) > GEO_MAX_CELLS:
+        return None
+    return ['%d:%d' % (i, j) for i in lat_range for j in long_range]
+
+def near(queryset, latitude, longitude, radius, limit=None):
+    """
+    Returns [(pk, distance in km), ...] of objects of queryset not farther
+    than radius km from point, nearest first
+    """
+    box = bounding_box(latitude, longitude, radius)
+    candidates = queryset.filter(latitude__gte=box[0], latitude__lte=box[1],
+        longitude__gte=box[2], longitude__lte=box[3])
+    cells = box_cells(box)
+    if cells is not None:
+        # Rows saved before cells was introduced have empty cell
+        candidates = candidates.filter(Q(geocell__in=cells) | Q(geocell=''))
+    rows = list(candidates.values_list('pk', 'latitude', 'longitude'))
+    if not rows:
+        return []
+    pks, latitudes, longitudes = zip(*rows)
+    distances = distances_from((latitude, longitude), latitudes, longitudes)
+    result = sorted([(d, pk) for pk, d in zip(pks, distances) if d <= radius])
+    if limit is not None:
+        result = result[:limit]
+    return [(pk, d) for d, pk in result]
+
+def fill_geo_cells(model):
+    """
+    Set geocell for rows of model with empty or outdated cell, returns count of updated rows
+    """
+    by_cell = dict()
+    for pk, latitude, longitude, cell in model.objects.values_list('pk', 'latitude', 'longitude', 'geocell'):
+        new_cell = geo_cell(latitude, longitude)
+        if new_cell != cell:
+            by_cell.setdefault(new_cell, []).append(pk)
+    count = 0
+    for cell, pks in by_cell.items():
+        for i in range(0, len(pks), 500):
+            count += model.objects.filter(pk__in=pks[i:i + 500]).update(geocell=cell)
+    return count
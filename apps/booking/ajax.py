@@ -12,13 +12,18 @@ from django.db.models.aggregates import Avg
 from django.utils.translation import ugettext_lazy as _
 from nnmware.apps.address.models import City
 from nnmware.apps.booking.models import SettlementVariant, PlacePrice, Room, Availability, Hotel, RequestAddHotel, Review, Booking, PaymentMethod, Discount
+from nnmware.apps.booking.inventory import inventory_update
+from nnmware.apps.booking.ari import room_ari_update
+from nnmware.apps.booking.prices import price_matrix
 from nnmware.apps.money.models import Currency
 import time
 from nnmware.core.imgutil import make_thumbnail
 from nnmware.core.templatetags.jcomments import get_image_attach_url
 from nnmware.core.utils import convert_to_date
 from nnmware.core.ajax import AjaxLazyAnswer
-from django.views.decorators.cache import never_cache
+from nnmware.core.config import CURRENCY
+from django.views.decorators.cache import never_cache, cache_control
+from django.views.decorators.http import condition
 
 class UserNotAllowed(Exception):
     pass
@@ -35,21 +40,24 @@ def room_rates(request):
         if request.user not in room.hotel.admins.all() and not request.user.is_superuser:
             raise UserNotAllowed
         # find settlements keys in data
-        all_settlements, discount = [],[]
+        all_settlements, discount = dict(),[]
         for k in json_data.keys():
             if k[0] == 's':
-                all_settlements.append(k)
+                try:
+                    all_settlements[k] = int(k[1:])
+                except ValueError:
+                    pass
             elif k == 'discount':
                 discount.append(k)
+        room_settlements = SettlementVariant.objects.filter(room=room).values_list('id', flat=True)
+        if set(all_settlements.values()) - set(room_settlements):
+            raise RatesError
+        placecounts, discounts, prices = dict(), dict(), dict()
         for i, v in enumerate(json_data['dates']):
-            on_date = datetime.fromtimestamp(time.mktime(time.strptime(v, "%d%m%Y")))
+            on_date = datetime.fromtimestamp(time.mktime(time.strptime(v, "%d%m%Y"))).date()
             if 'placecount' in json_data.keys():
                 try:
-                    placecount = int(json_data['placecount'][i])
-                    # store availability
-                    availability, created = Availability.objects.get_or_create(date=on_date, room=room)
-                    availability.placecount = placecount
-                    availability.save()
+                    placecounts[on_date] = int(json_data['placecount'][i])
                 except ValueError:
                     pass
             for k in discount:
@@ -57,23 +65,17 @@ def room_rates(request):
                     discount_on_date = int(json_data[k][i])
                     if discount_on_date < 1 or discount_on_date > 99 :
                         raise ValueError
-                    d, created = Discount.objects.get_or_create(date=on_date, room=room)
-                    d.discount = discount_on_date
-                    d.save()
+                    discounts[on_date] = discount_on_date
                 except ValueError:
                     pass
-            for k in all_settlements:
+            for k, settlement_id in all_settlements.items():
                 try:
-                    settlement_id = int(k[1:])
-                    settlement = SettlementVariant.objects.get(id=settlement_id)
-                    price = int(json_data[k][i])
-                    placeprice, created = PlacePrice.objects.get_or_create(date=on_date,settlement=settlement)
-                    placeprice.amount = price
-                    placeprice.currency = currency
-                    placeprice.save()
+                    prices.setdefault(settlement_id, dict())[on_date] = int(json_data[k][i])
                 except ValueError:
                     pass
-        payload = {'success': True}
+        result = room_ari_update(room, placecounts, discounts, prices, currency)
+        inventory_update(room.pk, placecounts)
+        payload = {'success': True, 'inserted': result['inserted'], 'updated': result['updated']}
     except UserNotAllowed:
         payload = {'success': False}
     except :
@@ -145,6 +147,55 @@ def get_booking_amount(request):
         payload = {'success': False}
     return AjaxLazyAnswer(payload)
 
+def quote_last_modified(request):
+    try:
+        return Hotel.objects.filter(pk=request.REQUEST['hotel']).values_list('ari_updated_date', flat=True)[0]
+    except :
+        return None
+
+@cache_control(max_age=60)
+@condition(last_modified_func=quote_last_modified)
+def hotel_quotes(request):
+    try:
+        hotel = Hotel.objects.get(pk=request.REQUEST['hotel'])
+        from_date = convert_to_date(request.REQUEST['from']).date()
+        to_date = convert_to_date(request.REQUEST['to']).date()
+        if from_date > to_date:
+            from_date, to_date = to_date, from_date
+        guests = [int(g) for g in request.REQUEST.getlist('guests')]
+        settlements = SettlementVariant.objects.filter(room__hotel=hotel, enabled=True)
+        if guests:
+            settlements = settlements.filter(settlement__in=guests)
+        settlements = list(settlements.order_by('room', 'settlement').values_list('id', 'room', 'settlement'))
+        rooms = set([room_id for s_id, room_id, settlement in settlements])
+        prices = price_matrix([s_id for s_id, room_id, settlement in settlements], from_date, to_date)
+        placecounts = dict()
+        for room_id, on_date, placecount in Availability.objects.filter(room__in=rooms,
+                date__gte=from_date, date__lt=to_date).values_list('room', 'date', 'placecount'):
+            placecounts[(room_id, on_date)] = placecount
+        discounts = dict()
+        for room_id, on_date, discount in Discount.objects.filter(room__in=rooms,
+                date__gte=from_date, date__lt=to_date).values_list('room', 'date', 'discount'):
+            discounts[(room_id, on_date)] = discount
+        results = []
+        for s_id, room_id, settlement in settlements:
+            nights = []
+            amount, amount_discount = 0, 0
+            for on_date, price in zip(prices.dates, prices.row(s_id)):
+                discount = discounts.get((room_id, on_date), 0)
+                price_discount = (price*(100-discount))/100
+                amount += price
+                amount_discount += price_discount
+                nights.append({'date':on_date.strftime("%d.%m.%Y"), 'price':int(price),
+                               'discount':discount, 'price_discount':int(price_discount),
+                               'placecount':placecounts.get((room_id, on_date), 0)})
+            results.append({'room':room_id, 'settlement':s_id, 'guests':settlement, 'nights':nights,
+                            'amount':int(amount), 'amount_discount':int(amount_discount)})
+        payload = {'success': True, 'dayscount':len(prices.dates), 'currency':CURRENCY, 'quotes':results}
+    except :
+        payload = {'success': False}
+    return AjaxLazyAnswer(payload)
+
 def hotel_add(request):
     try:
         if not request.user.is_superuser:
@@ -223,14 +274,15 @@ def tourism_places(request):
         h = request.REQUEST['hotel']
         hotel = Hotel.objects.get(pk=h)
         results = []
-        for tourism in hotel.tourism_places().order_by('category'):
+        for tourism in hotel.tourism_places():
             if tourism.category.icon:
                 icon = tourism.category.icon.url
             else:
                 icon = ''
             answer = {'name':tourism.get_name, 'latitude':tourism.latitude,
                       'category':tourism.category.name,'category_id':tourism.category.pk,
-                      'longitude':tourism.longitude,'icon':icon, 'id':tourism.pk }
+                      'longitude':tourism.longitude,'icon':icon, 'id':tourism.pk,
+                      'distance':round(tourism.distance, 2) }
             results.append(answer)
         payload = {'success': True, 'tourism':results}
     except :
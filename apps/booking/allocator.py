@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Booking system_id allocator.
+
+Counter values are reserved from database in blocks, so every process
+take numbers without queries most of time, and passed through Feistel
+permutation to look random. New numbers is 10 digits and never collide
+with old random 9 digits numbers. Block is reserved in own transaction
+and never returned back by rollback of booking.
+"""
+import hashlib
+import struct
+import threading
+from django.conf import settings
+from django.db import connection, connections, transaction, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.db.utils import load_backend
+from nnmware.core.utils import commit_on_success_unless_managed
+
+SYSTEM_ID_KEY = getattr(settings, 'BOOKING_SYSTEM_ID_KEY', 'nnmware-booking')
+SYSTEM_ID_BLOCK = getattr(settings, 'BOOKING_SYSTEM_ID_BLOCK', 100)
+SYSTEM_ID_MIN = 1000000000
+SYSTEM_ID_COUNT = 1000000000
+HALF_BITS = 15
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 6
+
+
+def _round(i, value, key):
+    digest = hashlib.md5('%s:%d:%d' % (key, i, value)).digest()
+    return struct.unpack('>I', digest[:4])[0] & HALF_MASK
+
+def _feistel(value, key):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for i in range(ROUNDS):
+        left, right = right, left ^ _round(i, right, key)
+    return (left << HALF_BITS) | right
+
+def permute(n, key=SYSTEM_ID_KEY):
+    """
+    Bijection of [0, SYSTEM_ID_COUNT) to itself, cycle walking keep
+    values of 30 bits Feistel network inside of range.
+    """
+    if not 0 <= n < SYSTEM_ID_COUNT:
+        raise ValueError('Counter %s out of system id range' % n)
+    n = _feistel(n, key)
+    while n >= SYSTEM_ID_COUNT:
+        n = _feistel(n, key)
+    return n
+
+
+class SystemIdAllocator(object):
+
+    def __init__(self, block=SYSTEM_ID_BLOCK):
+        self.block = block
+        self.lock = threading.Lock()
+        self.next = 0
+        self.last = 0
+
+    def _reserve(self):
+        from nnmware.apps.booking.models import BookingSequence
+        if transaction.is_managed() and connection.vendor != 'sqlite':
+            # Transaction of booking can be rolled back, counter is moved by other connection
+            last = _reserve_apart(BookingSequence, self.block)
+        else:
+            # Sqlite allow one writer, other connection would wait for transaction of caller
+            with commit_on_success_unless_managed():
+                last = _reserve_here(BookingSequence, self.block)
+        self.next, self.last = last - self.block, last
+
+    def counter(self):
+        with self.lock:
+            if self.next >= self.last:
+                self._reserve()
+            value = self.next
+            self.next += 1
+            return value
+
+    def allocate(self):
+        return SYSTEM_ID_MIN + permute(self.counter())
+
+def _reserve_here(model, block):
+    if not model.objects.filter(pk=1).update(value=F('value') + block):
+        try:
+            sid = transaction.savepoint()
+            model.objects.create(pk=1, value=block)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Other process create counter right now
+            transaction.savepoint_rollback(sid)
+            model.objects.filter(pk=1).update(value=F('value') + block)
+    return model.objects.get(pk=1).value
+
+def _reserve_apart(model, block):
+    settings_dict = connections.databases[DEFAULT_DB_ALIAS]
+    own = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, DEFAULT_DB_ALIAS)
+    table = own.ops.quote_name(model._meta.db_table)
+    pk = own.ops.quote_name(model._meta.pk.column)
+    value = own.ops.quote_name(model._meta.get_field('value').column)
+    update = 'UPDATE %s SET %s = %s + %%s WHERE %s = 1' % (table, value, value, pk)
+    try:
+        cursor = own.cursor()
+        cursor.execute(update, [block])
+        if not cursor.rowcount:
+            try:
+                cursor.execute('INSERT INTO %s (%s, %s) VALUES (1, %%s)' % (table, pk, value), [block])
+            except (IntegrityError, own.Database.IntegrityError):
+                own._rollback()
+                cursor = own.cursor()
+                cursor.execute(update, [block])
+        cursor.execute('SELECT %s FROM %s WHERE %s = 1' % (value, table, pk))
+        last = cursor.fetchone()[0]
+        own._commit()
+    finally:
+        own.close()
+    return last
+
+_allocator = SystemIdAllocator()
+
+def allocate_system_id():
+    return _allocator.allocate()
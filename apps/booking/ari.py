@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk write of availability, rates and discounts (ARI) for room
+"""
+from django.db import transaction
+from nnmware.apps.booking.models import Availability, Discount, PlacePrice, SettlementVariant, hotel_ari_changed
+from nnmware.apps.booking.availability import as_date
+from nnmware.apps.booking.prices import mark_amount_dirty
+from nnmware.apps.booking.rollup import refresh_remaining
+
+UPDATE_CHUNK = 500
+
+
+def _bulk_update(model, changed, field, **extra):
+    """
+    changed is {pk: new value}, rows with same value updated by one query
+    """
+    by_value = dict()
+    for pk, value in changed.items():
+        by_value.setdefault(value, []).append(pk)
+    for value, pks in by_value.items():
+        values = dict(extra)
+        values[field] = value
+        for i in range(0, len(pks), UPDATE_CHUNK):
+            model.objects.filter(pk__in=pks[i:i + UPDATE_CHUNK]).update(**values)
+
+def _upsert(model, existing, new_values, field, make, **extra):
+    """
+    existing is {key: (pk, old value)}, new_values is {key: value}.
+    Returns (inserted, updated)
+    """
+    changed = dict()
+    created = []
+    for key, value in new_values.items():
+        if key in existing:
+            pk, old = existing[key]
+            if old != value:
+                changed[pk] = value
+        else:
+            created.append(make(key, value))
+    if created:
+        model.objects.bulk_create(created)
+    _bulk_update(model, changed, field, **extra)
+    return len(created), len(changed)
+
+def _write_room_ari(room_id, placecounts, discounts, prices, currency):
+    """
+    Upsert ARI of one room without transaction and signals.
+    Returns (inserted, updated, prices changed, placecounts changed)
+    """
+    placecounts = dict([(as_date(d), v) for d, v in (placecounts or dict()).items()])
+    discounts = dict([(as_date(d), v) for d, v in (discounts or dict()).items()])
+    prices = dict([(settlement_id, dict([(as_date(d), v) for d, v in amounts.items()]))
+                   for settlement_id, amounts in (prices or dict()).items()])
+    inserted, updated = 0, 0
+    prices_changed, placecounts_changed = False, False
+    if placecounts:
+        existing = dict()
+        for pk, on_date, placecount in Availability.objects.filter(room=room_id,
+                date__in=placecounts.keys()).values_list('pk', 'date', 'placecount'):
+            existing[on_date] = (pk, placecount)
+        i, u = _upsert(Availability, existing, placecounts, 'placecount',
+            lambda d, v: Availability(room_id=room_id, date=d, placecount=v))
+        inserted, updated = inserted + i, updated + u
+        placecounts_changed = bool(i or u)
+    if discounts:
+        existing = dict()
+        for pk, on_date, discount in Discount.objects.filter(room=room_id,
+                date__in=discounts.keys()).values_list('pk', 'date', 'discount'):
+            existing[on_date] = (pk, discount)
+        i, u = _upsert(Discount, existing, discounts, 'discount',
+            lambda d, v: Discount(room_id=room_id, date=d, discount=v))
+        inserted, updated = inserted + i, updated + u
+    if prices:
+        all_dates = set()
+        new_values = dict()
+        for settlement_id, amounts in prices.items():
+            for on_date, amount in amounts.items():
+                all_dates.add(on_date)
+                new_values[(settlement_id, on_date)] = amount
+        existing = dict()
+        for pk, settlement_id, on_date, amount, currency_id in PlacePrice.objects.filter(
+                settlement__in=prices.keys(), date__in=all_dates).values_list('pk', 'settlement',
+                'date', 'amount', 'currency'):
+            if currency is not None and currency_id != currency.pk:
+                # Price in other currency must be rewritten
+                amount = None
+            existing[(settlement_id, on_date)] = (pk, amount)
+        i, u = _upsert(PlacePrice, existing, new_values, 'amount',
+            lambda key, v: PlacePrice(settlement_id=key[0], date=key[1], amount=v, currency=currency),
+            currency=currency)
+        inserted, updated = inserted + i, updated + u
+        prices_changed = bool(i or u)
+    return inserted, updated, prices_changed, placecounts_changed
+
+def hotel_ari_update(hotel_id, rooms, currency=None):
+    """
+    Store ARI of rooms of one hotel in one transaction, rooms is
+    {room_id: (placecounts, discounts, prices)} as for room_ari_update.
+    Returns {'inserted': count, 'updated': count}
+    """
+    inserted, updated = 0, 0
+    prices_changed = False
+    remaining_dates = set()
+    with transaction.commit_on_success():
+        for room_id, (placecounts, discounts, prices) in rooms.items():
+            i, u, p, a = _write_room_ari(room_id, placecounts, discounts, prices, currency)
+            inserted, updated = inserted + i, updated + u
+            prices_changed = prices_changed or p
+            if a:
+                remaining_dates.update([as_date(d) for d in placecounts.keys()])
+        if prices_changed:
+            mark_amount_dirty(pk=hotel_id)
+        if remaining_dates:
+            refresh_remaining(dates=remaining_dates, pk=hotel_id)
+        if inserted or updated:
+            hotel_ari_changed(pk=hotel_id)
+    return {'inserted': inserted, 'updated': updated}
+
+def room_ari_update(room, placecounts=None, discounts=None, prices=None, currency=None):
+    """
+    Store in one transaction placecounts {date: placecount}, discounts
+    {date: discount} and prices {settlement_id: {date: amount}} of room.
+    Existing rows read with one query for every table.
+    Returns {'inserted': count, 'updated': count}
+    """
+    return hotel_ari_update(room.hotel_id, {room.pk: (placecounts or dict(), discounts, prices)}, currency)
+
+def room_ari_grid(room, dates):
+    """
+    Availability, discount and prices of active settlements of room for
+    every date with one range query for every table. Returns (settlements,
+    rows), row is {'date', 'placecount', 'discount', 'prices': [(settlement, amount), ...]},
+    missing values are ''.
+    """
+    settlements = list(SettlementVariant.objects.filter(room=room, enabled=True).order_by('settlement'))
+    dates = [as_date(d) for d in dates]
+    if not dates:
+        return settlements, []
+    from_date, to_date = min(dates), max(dates)
+    placecounts = dict(Availability.objects.filter(room=room, date__gte=from_date,
+        date__lte=to_date).values_list('date', 'placecount'))
+    discounts = dict(Discount.objects.filter(room=room, date__gte=from_date,
+        date__lte=to_date).values_list('date', 'discount'))
+    prices = dict()
+    for settlement_id, on_date, amount in PlacePrice.objects.filter(settlement__in=settlements,
+            date__gte=from_date, date__lte=to_date).values_list('settlement', 'date', 'amount'):
+        prices[(settlement_id, on_date)] = int(amount)
+    rows = []
+    for on_date in dates:
+        discount = discounts.get(on_date)
+        rows.append({'date': on_date,
+                     'placecount': placecounts.get(on_date, ''),
+                     'discount': '' if discount is None else int(discount),
+                     'prices': [(s, prices.get((s.pk, on_date), '')) for s in settlements]})
+    return settlements, rows
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Import of ARI feeds from channel managers. Feed is CSV with header or
+JSON lines with fields room, settlement, date, price, placecount and
+discount, room and settlement are ids of Room and SettlementVariant.
+Rows are read line by line and written by hotel_ari_update in batches,
+offset in file after last written batch can be used to resume import.
+"""
+import csv
+import json
+from datetime import datetime
+from django.conf import settings
+from nnmware.apps.booking.models import Room, SettlementVariant
+from nnmware.apps.booking.ari import hotel_ari_update
+from nnmware.apps.booking.inventory import inventory_update
+
+ARI_IMPORT_BATCH = getattr(settings, 'ARI_IMPORT_BATCH', 5000)
+ARI_IMPORT_FORMATS = ('csv', 'jsonl')
+ARI_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+ARI_MAX_ERRORS = 20
+
+
+class AriRowError(ValueError):
+    pass
+
+def ari_maps():
+    """
+    Returns ({room_id: hotel_id}, {settlement_id: room_id})
+    """
+    rooms = dict(Room.objects.filter(hotel__isnull=False).values_list('pk', 'hotel'))
+    settlements = dict(SettlementVariant.objects.values_list('pk', 'room'))
+    return rooms, settlements
+
+def _lines(f, position):
+    # Offset is counted from lines, pipes don't support tell()
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        position += len(line)
+        yield position, line
+
+def ari_rows(f, file_format, offset=0):
+    """
+    Yields (offset after row, row dict), reading starts from offset.
+    Nonzero offset needs seekable file.
+    """
+    if file_format == 'csv':
+        line = f.readline()
+        header = [h.strip() for h in csv.reader([line]).next()]
+        position = len(line)
+        if offset > position:
+            f.seek(offset)
+            position = offset
+        for position, line in _lines(f, position):
+            if line.strip():
+                yield position, dict(zip(header, csv.reader([line]).next()))
+    else:
+        if offset:
+            f.seek(offset)
+        for position, line in _lines(f, offset):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield position, row
+
+def _value(row, name, convert):
+    value = row.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise AriRowError('Wrong %s %r' % (name, value))
+
+def _date(value):
+    for date_format in ARI_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError
+
+def parse_ari_row(row, rooms, settlements):
+    """
+    Validate row against maps of ari_maps. Returns (hotel_id, room_id,
+    date, settlement_id, price, placecount, discount), missing values are None
+    """
+    if not isinstance(row, dict):
+        raise AriRowError('Row is not an object')
+    room_id = _value(row, 'room', int)
+    if room_id not in rooms:
+        raise AriRowError('Unknown room %r' % row.get('room'))
+    on_date = _value(row, 'date', _date)
+    if on_date is None:
+        raise AriRowError('Date is required')
+    settlement_id = _value(row, 'settlement', int)
+    price = _value(row, 'price', int)
+    placecount = _value(row, 'placecount', int)
+    discount = _value(row, 'discount', int)
+    if price is not None:
+        if settlement_id is None or settlements.get(settlement_id) != room_id:
+            raise AriRowError('Unknown settlement %r of room %s' % (row.get('settlement'), room_id))
+        if price < 0:
+            raise AriRowError('Negative price')
+    if placecount is not None and placecount < 0:
+        raise AriRowError('Negative placecount')
+    if discount is not None and not 1 <= discount <= 99:
+        raise AriRowError('Discount must be from 1 to 99')
+    return rooms[room_id], room_id, on_date, settlement_id, price, placecount, discount
+
+def _write_batch(batch, currency, stats):
+    for hotel_id, rooms in batch.items():
+        result = hotel_ari_update(hotel_id, rooms, currency)
+        stats['inserted'] += result['inserted']
+        stats['updated'] += result['updated']
+        for room_id, (placecounts, discounts, prices) in rooms.items():
+            if placecounts:
+                inventory_update(room_id, placecounts)
+
+def import_ari(f, file_format, offset=0, currency=None, batch_size=ARI_IMPORT_BATCH, progress=None):
+    """
+    Import feed from file f starting from offset. After every written batch
+    progress(offset, stats) is called, stats is {'rows', 'skipped',
+    'inserted', 'updated', 'errors'}, errors are first invalid rows.
+    Returns stats.
+    """
+    rooms, settlements = ari_maps()
+    stats = {'rows': 0, 'skipped': 0, 'inserted': 0, 'updated': 0, 'errors': []}
+    batch, count, position = dict(), 0, offset
+    for position, row in ari_rows(f, file_format, offset):
+        stats['rows'] += 1
+        try:
+            hotel_id, room_id, on_date, settlement_id, price, placecount, discount = \
+                parse_ari_row(row, rooms, settlements)
+        except AriRowError, err:
+            stats['skipped'] += 1
+            if len(stats['errors']) < ARI_MAX_ERRORS:
+                stats['errors'].append((position, unicode(err)))
+            continue
+        placecounts, discounts, prices = batch.setdefault(hotel_id, dict()).setdefault(room_id,
+            (dict(), dict(), dict()))
+        if placecount is not None:
+            placecounts[on_date] = placecount
+        if discount is not None:
+            discounts[on_date] = discount
+        if price is not None:
+            prices.setdefault(settlement_id, dict())[on_date] = price
+        count += 1
+        if count >= batch_size:
+            _write_batch(batch, currency, stats)
+            batch, count = dict(), 0
+            if progress is not None:
+                progress(position, stats)
+    if batch:
+        _write_batch(batch, currency, stats)
+    if progress is not None:
+        progress(position, stats)
+    return stats
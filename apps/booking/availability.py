@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from django.db import connection
+from django.db.models import F
+from nnmware.apps.booking.models import Room, Availability, SettlementVariant, hotel_ari_changed
+from nnmware.apps.booking.inventory import INVENTORY_ENABLED, get_index
+from nnmware.core.utils import commit_on_success_unless_managed
+
+
+class NotEnoughPlaces(Exception):
+    pass
+
+def as_date(d):
+    if isinstance(d, datetime):
+        return d.date()
+    return d
+
+FREE_ROOMS_SQL = """SELECT r.id, r.hotel_id FROM %(availability)s a
+    INNER JOIN %(room)s r ON r.id = a.room_id
+    INNER JOIN (SELECT room_id, MAX(settlement) AS places FROM %(settlement)s
+        WHERE enabled = %%s GROUP BY room_id) s ON s.room_id = a.room_id
+    WHERE %(column)s IN (%(ids)s) AND a.date >= %%s AND a.date < %%s
+        AND a.placecount * s.places >= %%s
+    GROUP BY r.id, r.hotel_id HAVING COUNT(DISTINCT a.date) = %%s"""
+
+QUERY_CHUNK = 500
+
+def _free_rooms_db(column, ids, from_date, to_date, roomcount):
+    result = []
+    cursor = connection.cursor()
+    for i in range(0, len(ids), QUERY_CHUNK):
+        chunk = list(ids[i:i + QUERY_CHUNK])
+        query = FREE_ROOMS_SQL % {'availability': Availability._meta.db_table,
+                                  'room': Room._meta.db_table,
+                                  'settlement': SettlementVariant._meta.db_table,
+                                  'column': column,
+                                  'ids': ','.join(['%s'] * len(chunk))}
+        params = [True] + chunk + [from_date, to_date, roomcount, (to_date - from_date).days]
+        cursor.execute(query, params)
+        result += cursor.fetchall()
+    return result
+
+def _free_rooms_index(hotels_id, from_date, to_date, roomcount):
+    """
+    Returns (list of (room_id, hotel_id), list of rooms which index can't answer)
+    """
+    hotel_of = dict(Room.objects.filter(hotel__in=hotels_id).values_list('id', 'hotel'))
+    try:
+        free, unknown = get_index().free_rooms(hotel_of.keys(), from_date, to_date, roomcount)
+    except (IOError, OSError):
+        free, unknown = [], hotel_of.keys()
+    return [(room_id, hotel_of[room_id]) for room_id in free], unknown
+
+def free_rooms(hotels, from_date, to_date, roomcount):
+    """
+    Returns dict {hotel_id: [room_id, ...]} with rooms, which have at least
+    roomcount places (max enabled settlement * placecount) for every night
+    in [from_date, to_date). Same rules as Room.date_place_count, but answer
+    come from inventory index and one grouped query for whole set of hotels.
+    """
+    if hasattr(hotels, 'values_list'):
+        hotels_id = list(hotels.values_list('pk', flat=True))
+    else:
+        hotels_id = [getattr(h, 'pk', h) for h in hotels]
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    nights = (to_date - from_date).days
+    result = dict()
+    if not hotels_id or nights < 1:
+        return result
+    if roomcount is None:
+        # Without guests count every room of hotel is free
+        for room_id, hotel_id in Room.objects.filter(hotel__in=hotels_id).values_list('id', 'hotel'):
+            result.setdefault(hotel_id, []).append(room_id)
+        return result
+    if INVENTORY_ENABLED:
+        rooms, unknown = _free_rooms_index(hotels_id, from_date, to_date, roomcount)
+        if unknown:
+            rooms += _free_rooms_db('r.id', unknown, from_date, to_date, roomcount)
+    else:
+        rooms = _free_rooms_db('r.hotel_id', hotels_id, from_date, to_date, roomcount)
+    for room_id, hotel_id in rooms:
+        result.setdefault(hotel_id, []).append(room_id)
+    return result
+
+def free_hotels(hotels, from_date, to_date, roomcount):
+    """
+    Returns list of id hotels with at least one free room on dates
+    """
+    return free_rooms(hotels, from_date, to_date, roomcount).keys()
+
+def _refresh_remaining(room, from_date, nights):
+    from nnmware.apps.booking.rollup import refresh_remaining
+    refresh_remaining(dates=[from_date + timedelta(days=i) for i in range(nights)],
+                      room__id=getattr(room, 'pk', room))
+
+def reserve_room(room, from_date, to_date, count=1):
+    """
+    Atomically decrement placecount of room for every night in [from_date, to_date).
+    Conditional update touch only nights with enough places, if some night
+    is not updated all changes rolled back and NotEnoughPlaces raised, in
+    transaction of caller only changes of reserve are rolled back.
+    Returns {date: new placecount}
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    nights = (to_date - from_date).days
+    with commit_on_success_unless_managed():
+        qs = Availability.objects.filter(room=room, date__gte=from_date, date__lt=to_date)
+        updated = qs.filter(placecount__gte=count).update(placecount=F('placecount') - count)
+        if updated != nights:
+            raise NotEnoughPlaces
+        hotel_ari_changed(room__id=getattr(room, 'pk', room))
+        _refresh_remaining(room, from_date, nights)
+        return dict(qs.values_list('date', 'placecount'))
+
+def release_room(room, from_date, to_date, count=1):
+    """
+    Return places of reserve_room back
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    with commit_on_success_unless_managed():
+        qs = Availability.objects.filter(room=room, date__gte=from_date, date__lt=to_date)
+        qs.update(placecount=F('placecount') + count)
+        hotel_ari_changed(room__id=getattr(room, 'pk', room))
+        _refresh_remaining(room, from_date, (to_date - from_date).days)
+        return dict(qs.values_list('date', 'placecount'))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Agent percents of hotel as sorted intervals: percent of AgentPercent is
+valid from its date to date of next AgentPercent. Intervals of hotel
+loaded with one query and cached until AgentPercent of hotel changed.
+"""
+from bisect import bisect_right
+from datetime import date, timedelta
+from decimal import Decimal
+from django.core.cache import cache
+from nnmware.apps.booking.models import AgentPercent, PlacePrice
+from nnmware.apps.booking.availability import as_date
+
+PERCENT_CACHE_KEY = 'nnmware_agent_percent_%s'
+PERCENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class PercentIndex(object):
+
+    def __init__(self, intervals):
+        # intervals is sorted list of (date, percent), last percent on same date win
+        by_date = dict()
+        for on_date, percent in intervals:
+            by_date[as_date(on_date).toordinal()] = percent
+        self.dates = sorted(by_date.keys())
+        self.percents = [by_date[d] for d in self.dates]
+        # Sum of percent for every night from first date to start of interval
+        self.sums = [Decimal(0)]
+        for i in range(1, len(self.dates)):
+            self.sums.append(self.sums[-1] + self.percents[i-1] * (self.dates[i] - self.dates[i-1]))
+
+    def _interval(self, ordinal):
+        i = bisect_right(self.dates, ordinal) - 1
+        if i < 0:
+            raise IndexError('No agent percent on %s' % date.fromordinal(ordinal))
+        return i
+
+    def percent_on_date(self, on_date):
+        return self.percents[self._interval(as_date(on_date).toordinal())]
+
+    def percents_on_dates(self, from_date, to_date):
+        """
+        Percent for every night in [from_date, to_date)
+        """
+        start, end = as_date(from_date).toordinal(), as_date(to_date).toordinal()
+        result = []
+        if start >= end:
+            return result
+        i = self._interval(start)
+        for night in range(start, end):
+            while i + 1 < len(self.dates) and self.dates[i + 1] <= night:
+                i += 1
+            result.append(self.percents[i])
+        return result
+
+    def _sum_before(self, ordinal):
+        i = self._interval(ordinal)
+        return self.sums[i] + self.percents[i] * (ordinal - self.dates[i])
+
+    def percent_sum(self, from_date, to_date):
+        """
+        Sum of percents of nights in [from_date, to_date)
+        """
+        start, end = as_date(from_date).toordinal(), as_date(to_date).toordinal()
+        if start >= end:
+            return Decimal(0)
+        return self._sum_before(end) - self._sum_before(start)
+
+
+def _intervals_from_db(hotels_id):
+    result = dict([(hotel_id, []) for hotel_id in hotels_id])
+    for hotel_id, on_date, percent in AgentPercent.objects.filter(hotel__in=hotels_id).order_by(
+            'date', 'pk').values_list('hotel', 'date', 'percent'):
+        result[hotel_id].append((on_date, percent))
+    return result
+
+def percent_indexes(hotels):
+    """
+    Returns {hotel_id: PercentIndex}, hotels not in cache loaded with one query
+    """
+    hotels_id = [getattr(h, 'pk', h) for h in hotels]
+    keys = dict([(PERCENT_CACHE_KEY % hotel_id, hotel_id) for hotel_id in hotels_id])
+    cached = cache.get_many(keys.keys())
+    intervals = dict([(keys[key], value) for key, value in cached.items()])
+    missing = [hotel_id for hotel_id in hotels_id if hotel_id not in intervals]
+    if missing:
+        loaded = _intervals_from_db(missing)
+        cache.set_many(dict([(PERCENT_CACHE_KEY % hotel_id, value) for hotel_id, value in loaded.items()]),
+            PERCENT_CACHE_TIMEOUT)
+        intervals.update(loaded)
+    return dict([(hotel_id, PercentIndex(value)) for hotel_id, value in intervals.items()])
+
+def percent_index(hotel):
+    hotel_id = getattr(hotel, 'pk', hotel)
+    return percent_indexes([hotel_id])[hotel_id]
+
+def clear_percent_index(hotel_id):
+    cache.delete(PERCENT_CACHE_KEY % hotel_id)
+
+def bookings_commission(bookings):
+    """
+    Recalculate commission of bookings by prices of settlement and agent
+    percents on every night. Returns {booking_id: commission}, bookings
+    without price or percent on some night is not in result.
+    """
+    bookings = [b for b in bookings if b.settlement_id and b.hotel_id and b.from_date < b.to_date]
+    if not bookings:
+        return dict()
+    indexes = percent_indexes(set([b.hotel_id for b in bookings]))
+    prices = dict()
+    for settlement_id, on_date, amount in PlacePrice.objects.filter(
+            settlement__in=set([b.settlement_id for b in bookings]),
+            date__gte=min([b.from_date for b in bookings]),
+            date__lt=max([b.to_date for b in bookings])).values_list('settlement', 'date', 'amount'):
+        prices[(settlement_id, on_date)] = amount
+    result = dict()
+    for booking in bookings:
+        try:
+            percents = indexes[booking.hotel_id].percents_on_dates(booking.from_date, booking.to_date)
+            commission = Decimal(0)
+            for i, percent in enumerate(percents):
+                price = prices[(booking.settlement_id, booking.from_date + timedelta(days=i))]
+                commission += (price*percent)/100
+            result[booking.pk] = commission
+        except (IndexError, KeyError):
+            pass
+    return result
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Counts of hotels per star class, search option and price bucket for
+hotels found by city, dates and guests. Counts come from two grouped
+queries and cached for normalized search.
+"""
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from nnmware.apps.booking.models import Hotel, HotelOption
+from nnmware.apps.booking.availability import QUERY_CHUNK
+from nnmware.apps.booking.prices import refresh_hotel_amounts
+
+FACETS_TIMEOUT = getattr(settings, 'BOOKING_FACETS_TIMEOUT', 300)
+# Bounds of price buckets in default currency
+PRICE_BUCKETS = getattr(settings, 'BOOKING_PRICE_BUCKETS', (1000, 2000, 3000, 5000, 10000))
+
+STARS_PRICES_SQL = """SELECT starcount, bucket, COUNT(*) FROM (SELECT starcount, %(bucket)s AS bucket
+    FROM %(hotel)s WHERE id IN (%(ids)s)) h GROUP BY starcount, bucket"""
+
+OPTIONS_SQL = """SELECT o.%(option)s, COUNT(*) FROM %(through)s o
+    INNER JOIN %(hoteloption)s ho ON ho.id = o.%(option)s
+    WHERE ho.in_search = %%s AND o.%(hotel)s IN (%(ids)s)
+    GROUP BY o.%(option)s"""
+
+
+def _bucket_sql():
+    whens = ['WHEN current_amount <= 0 THEN NULL']
+    for i, bound in enumerate(PRICE_BUCKETS):
+        whens.append('WHEN current_amount < %d THEN %d' % (int(bound), i))
+    return 'CASE %s ELSE %d END' % (' '.join(whens), len(PRICE_BUCKETS))
+
+def facets_key(city, from_date=None, to_date=None, guests=None, version=None):
+    if from_date is None:
+        # Guests matter only in search on dates
+        guests = None
+    search = (getattr(city, 'pk', city), from_date and from_date.isoformat(),
+              to_date and to_date.isoformat(), guests, version)
+    return 'nnmware_hotel_facets_%s' % md5(repr(search)).hexdigest()
+
+def _count_facets(hotels_id):
+    stars, options = dict(), dict()
+    prices = [0] * (len(PRICE_BUCKETS) + 1)
+    field = Hotel._meta.get_field('option')
+    cursor = connection.cursor()
+    for i in range(0, len(hotels_id), QUERY_CHUNK):
+        chunk = list(hotels_id[i:i + QUERY_CHUNK])
+        ids = ','.join(['%s'] * len(chunk))
+        cursor.execute(STARS_PRICES_SQL % {'bucket': _bucket_sql(),
+                                           'hotel': Hotel._meta.db_table,
+                                           'ids': ids}, chunk)
+        for starcount, bucket, count in cursor.fetchall():
+            stars[starcount] = stars.get(starcount, 0) + count
+            if bucket is not None:
+                prices[int(bucket)] += count
+        cursor.execute(OPTIONS_SQL % {'option': field.m2m_reverse_name(),
+                                      'hotel': field.m2m_column_name(),
+                                      'through': field.m2m_db_table(),
+                                      'hoteloption': HotelOption._meta.db_table,
+                                      'ids': ids}, [True] + chunk)
+        for option_id, count in cursor.fetchall():
+            options[option_id] = options.get(option_id, 0) + count
+    bounds = [None] + list(PRICE_BUCKETS) + [None]
+    return {'stars': stars,
+            'options': options,
+            'prices': [(bounds[i], bounds[i + 1], count) for i, count in enumerate(prices)]}
+
+def hotel_facets(hotels, key=None):
+    """
+    Returns {'stars': {starcount: count}, 'options': {option_id: count},
+    'prices': [(from amount or None, to amount or None, count), ...]}
+    for queryset of hotels, cached by key when it given
+    """
+    if key is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+    # Price buckets need fresh current_amount
+    refresh_hotel_amounts(hotels.filter(amount_dirty=True).values_list('pk', flat=True))
+    result = _count_facets(list(hotels.order_by().values_list('pk', flat=True)))
+    if key is not None:
+        cache.set(key, result, FACETS_TIMEOUT)
+    return result
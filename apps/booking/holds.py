@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Temporary holds of room between booking form and booking. Opening of
+form reserve places of stay for BOOKING_HOLD_TTL seconds and freeze
+amount and commission, booking takes them from hold. Expired holds
+returned back in bulk by release_expired_holds.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db.models import F
+from nnmware.apps.booking.models import Availability, BookingHold, PlacePrice, hotel_ari_changed
+from nnmware.apps.booking.availability import as_date, reserve_room
+from nnmware.apps.booking.inventory import inventory_update, inventory_after_commit
+from nnmware.apps.booking.rollup import refresh_remaining
+from nnmware.core.utils import daterange, commit_on_success_unless_managed
+
+BOOKING_HOLD_TTL = getattr(settings, 'BOOKING_HOLD_TTL', 15 * 60)
+HOLDS_CHUNK = 500
+
+
+def booking_quote(settlement, from_date, to_date):
+    """
+    Returns (amount, commission) of stay or None if some night has no price
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    prices = dict(PlacePrice.objects.filter(settlement=settlement, date__gte=from_date, date__lt=to_date,
+        amount__gt=0).values_list('date', 'amount'))
+    if len(prices) != (to_date - from_date).days:
+        return None
+    try:
+        percents = settlement.room.hotel.get_percents_on_dates(from_date, to_date)
+    except IndexError:
+        return None
+    amount, commission = Decimal(0), Decimal(0)
+    for i, on_date in enumerate(daterange(from_date, to_date)):
+        amount += prices[on_date]
+        commission += (prices[on_date] * percents[i]) / 100
+    return amount, commission
+
+def _session_holds(session_key, room, settlement, from_date, to_date):
+    return BookingHold.objects.filter(session_key=session_key, room=room, settlement=settlement,
+        from_date=as_date(from_date), to_date=as_date(to_date), expire_date__gt=datetime.now())
+
+def hold_room(session_key, room, settlement, from_date, to_date):
+    """
+    Returns live hold of session for stay, new hold created and other holds
+    of session released. None if stay has no price, NotEnoughPlaces raised
+    if room is sold out.
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    holds = list(_session_holds(session_key, room, settlement, from_date, to_date)[:1])
+    if holds:
+        return holds[0]
+    quote = booking_quote(settlement, from_date, to_date)
+    if quote is None:
+        return None
+    with inventory_after_commit():
+        with commit_on_success_unless_managed():
+            release_holds(BookingHold.objects.filter(session_key=session_key))
+            placecounts = reserve_room(room, from_date, to_date)
+            inventory_update(room.pk, placecounts)
+            hold = BookingHold(session_key=session_key, room=room, settlement=settlement, from_date=from_date,
+                to_date=to_date, amount=quote[0], commission=quote[1],
+                expire_date=datetime.now() + timedelta(seconds=BOOKING_HOLD_TTL))
+            hold.save()
+    return hold
+
+def take_hold(session_key, room, settlement, from_date, to_date):
+    """
+    Remove live hold of session for stay and return it, places stay
+    reserved for booking. Must be called in transaction with save of
+    booking. Returns None if there is no live hold.
+    """
+    holds = list(_session_holds(session_key, room, settlement, from_date, to_date).select_for_update()[:1])
+    if not holds:
+        return None
+    holds[0].delete()
+    return holds[0]
+
+def release_holds(holds):
+    """
+    Return places of holds from queryset and delete them, one update for
+    every room and count of places. Returns count of holds. In transaction
+    of caller places are returned only with it.
+    """
+    released = dict()
+    pks = []
+    with inventory_after_commit():
+        with commit_on_success_unless_managed():
+            for pk, room_id, from_date, to_date, roomcount in holds.select_for_update().values_list('pk',
+                    'room', 'from_date', 'to_date', 'roomcount'):
+                pks.append(pk)
+                nights = released.setdefault(room_id, dict())
+                for on_date in daterange(from_date, to_date):
+                    nights[on_date] = nights.get(on_date, 0) + roomcount
+            if not pks:
+                return 0
+            for room_id, nights in released.items():
+                by_count = dict()
+                for on_date, count in nights.items():
+                    by_count.setdefault(count, []).append(on_date)
+                for count, dates in by_count.items():
+                    for i in range(0, len(dates), HOLDS_CHUNK):
+                        Availability.objects.filter(room=room_id, date__in=dates[i:i + HOLDS_CHUNK]).update(
+                            placecount=F('placecount') + count)
+                # Placecounts are read again when index is changed
+                inventory_update(room_id, nights)
+            for i in range(0, len(pks), HOLDS_CHUNK):
+                BookingHold.objects.filter(pk__in=pks[i:i + HOLDS_CHUNK]).delete()
+            hotel_ari_changed(room__id__in=released.keys())
+            for room_id, nights in released.items():
+                refresh_remaining(dates=nights.keys(), room__id=room_id)
+    return len(pks)
+
+def release_expired_holds(batch=1000):
+    """
+    Release holds expired before now, not more than batch in one
+    transaction. Returns count of holds.
+    """
+    count = 0
+    while True:
+        pks = list(BookingHold.objects.filter(expire_date__lte=datetime.now()).order_by(
+            'expire_date').values_list('pk', flat=True)[:batch])
+        if not pks:
+            break
+        released = release_holds(BookingHold.objects.filter(pk__in=pks, expire_date__lte=datetime.now()))
+        count += released
+        if len(pks) < batch:
+            break
+    return count
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Shared room inventory index.
+
+One row per room in memory-mapped file, so all worker processes on host
+use one copy. Row is generation counter, first date of row, max enabled
+settlement of room and HORIZON int16 values of Availability.placecount.
+Writers take exclusive file lock and make generation odd while row is
+changed (seqlock), readers retry or fall back to database when they
+catch odd or changed generation.
+
+Changes made inside inventory_after_commit are published only when block
+is done, with values read from database, so rolled back transaction
+never reach index.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from array import array
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.db.models import Max
+from nnmware.apps.booking.models import Availability, SettlementVariant
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INVENTORY_FILE = getattr(settings, 'BOOKING_INVENTORY_FILE', '/var/tmp/nnmware_inventory.idx')
+INVENTORY_ENABLED = getattr(settings, 'BOOKING_INVENTORY_INDEX', True)
+HORIZON = getattr(settings, 'BOOKING_INVENTORY_HORIZON', 400)
+
+MAGIC = 'NNMI'
+HEADER = struct.Struct('=4siiI')  # magic, horizon, capacity, generation of rebuild
+HEADER_SIZE = 64
+ROW_HEADER = struct.Struct('=Iihh')  # generation, first date ordinal, places, reserved
+ROW_SIZE = ROW_HEADER.size + HORIZON * 2
+ROW_WORDS = ROW_SIZE / 2
+DATA_WORDS = ROW_HEADER.size / 2
+
+NOT_LOADED = -32768  # day is not in index, ask database
+NOT_FILLED = -1  # no Availability row for day
+UNKNOWN_PLACES = -1  # row created by write before rebuild
+MAX_PLACECOUNT = 32767
+CAPACITY_STEP = 1024
+READ_RETRIES = 3
+
+
+def _ordinal(d):
+    if isinstance(d, datetime):
+        d = d.date()
+    return d.toordinal()
+
+def _clamp(placecount):
+    return max(min(int(placecount), MAX_PLACECOUNT), 0)
+
+
+class InventoryIndex(object):
+
+    def __init__(self, path=INVENTORY_FILE, horizon=HORIZON):
+        self.path = path
+        self.horizon = horizon
+        self.fd = None
+        self.mm = None
+        self.size = 0
+
+    def _open(self):
+        if self.mm is not None:
+            return
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < HEADER_SIZE:
+                os.ftruncate(self.fd, HEADER_SIZE)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, self.horizon, 0, 0))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self._map()
+
+    def _map(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.size = os.fstat(self.fd).st_size
+        self.mm = mmap.mmap(self.fd, self.size)
+
+    def _header(self):
+        magic, horizon, capacity, generation = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or horizon != self.horizon:
+            raise IOError('Inventory index %s has wrong format, rebuild it' % self.path)
+        return capacity, generation
+
+    def capacity(self):
+        self._open()
+        capacity, generation = self._header()
+        if HEADER_SIZE + capacity * ROW_SIZE > self.size:
+            # Other process grow file
+            self._map()
+        return capacity
+
+    def _grow(self, room_id):
+        # Call only under exclusive lock
+        capacity = self.capacity()
+        if room_id < capacity:
+            return
+        capacity = (room_id / CAPACITY_STEP + 1) * CAPACITY_STEP
+        os.ftruncate(self.fd, HEADER_SIZE + capacity * ROW_SIZE)
+        self._map()
+        struct.pack_into('=i', self.mm, 8, capacity)
+
+    def _offset(self, room_id):
+        return HEADER_SIZE + room_id * ROW_SIZE
+
+    def _lock(self):
+        self._open()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _read_row(self, room_id):
+        """
+        Returns (generation, first ordinal, places) of row or None
+        """
+        if room_id >= self.capacity():
+            return None
+        generation, first, places, reserved = ROW_HEADER.unpack_from(self.mm, self._offset(room_id))
+        if not generation:
+            return None
+        return generation, first, places
+
+    def _write_row(self, room_id, first, places, values):
+        offset = self._offset(room_id)
+        generation = ROW_HEADER.unpack_from(self.mm, offset)[0]
+        # Odd generation mark row as changing for readers
+        struct.pack_into('=I', self.mm, offset, generation + 1)
+        struct.pack_into('=ih', self.mm, offset + 4, first, places)
+        data = offset + ROW_HEADER.size
+        self.mm[data:data + self.horizon * 2] = values.tostring()
+        struct.pack_into('=I', self.mm, offset, generation + 2)
+
+    def _row_values(self, room_id):
+        data = self._offset(room_id) + ROW_HEADER.size
+        return array('h', self.mm[data:data + self.horizon * 2])
+
+    def update(self, room_id, placecounts=None, places=None):
+        """
+        Store changed placecount {date: placecount} and/or max settlement of room,
+        placecount None is day without Availability row. Days out of horizon
+        of row are ignored.
+        """
+        placecounts = placecounts or dict()
+        today = date.today().toordinal()
+        self._lock()
+        try:
+            self._grow(room_id)
+            row = self._read_row(room_id)
+            if row is None:
+                first, old_places = today, UNKNOWN_PLACES
+                values = array('h', [NOT_LOADED] * self.horizon)
+            else:
+                first, old_places = row[1], row[2]
+                values = self._row_values(room_id)
+            if places is None:
+                places = old_places
+            shift = max(today - first, 0)
+            if shift:
+                # Roll row forward to today, new days is not loaded yet
+                values = values[shift:] + array('h', [NOT_LOADED] * min(shift, self.horizon))
+                first += shift
+            for d, placecount in placecounts.items():
+                i = _ordinal(d) - first
+                if 0 <= i < self.horizon:
+                    values[i] = NOT_FILLED if placecount is None else _clamp(placecount)
+            self._write_row(room_id, first, places, values)
+            self.mm.flush()
+        finally:
+            self._unlock()
+
+    def rebuild(self, rooms=None):
+        """
+        Load placecount and max settlement for horizon from database
+        """
+        first = date.today()
+        last = first + timedelta(days=self.horizon)
+        availability = Availability.objects.filter(date__gte=first, date__lt=last, room__isnull=False)
+        settlements = SettlementVariant.objects.filter(enabled=True)
+        if rooms is not None:
+            availability = availability.filter(room__in=rooms)
+            settlements = settlements.filter(room__in=rooms)
+        places = dict(settlements.values('room').annotate(places=Max('settlement')).values_list('room', 'places'))
+        rows = dict()
+        for room_id in places.keys() + [getattr(r, 'pk', r) for r in rooms or []]:
+            rows[room_id] = array('h', [NOT_FILLED] * self.horizon)
+        for room_id, on_date, placecount in availability.values_list('room', 'date', 'placecount').iterator():
+            if room_id not in rows:
+                rows[room_id] = array('h', [NOT_FILLED] * self.horizon)
+            rows[room_id][(on_date - first).days] = _clamp(placecount)
+        self._lock()
+        try:
+            if rows:
+                self._grow(max(rows.keys()))
+            if rooms is None:
+                # Full rebuild drop rows of deleted rooms
+                for room_id in range(self.capacity()):
+                    if room_id not in rows and self._read_row(room_id) is not None:
+                        self._write_row(room_id, first.toordinal(), 0, array('h', [NOT_LOADED] * self.horizon))
+                capacity, generation = self._header()
+                struct.pack_into('=I', self.mm, 12, generation + 1)
+            for room_id, values in rows.items():
+                self._write_row(room_id, first.toordinal(), places.get(room_id, 0), values)
+            self.mm.flush()
+        finally:
+            self._unlock()
+        return len(rows)
+
+    def verify(self, rooms=None):
+        """
+        Returns list of (room_id, date, value in index, value in database)
+        """
+        first = date.today()
+        last = first + timedelta(days=self.horizon)
+        availability = Availability.objects.filter(date__gte=first, date__lt=last, room__isnull=False)
+        if rooms is not None:
+            availability = availability.filter(room__in=rooms)
+        in_db = dict()
+        for room_id, on_date, placecount in availability.values_list('room', 'date', 'placecount').iterator():
+            in_db[(room_id, on_date)] = _clamp(placecount)
+        room_ids = set([room_id for room_id, on_date in in_db.keys()])
+        if rooms is not None:
+            room_ids.update([getattr(r, 'pk', r) for r in rooms])
+        result = []
+        for room_id in sorted(room_ids):
+            row = self._read_row(room_id)
+            if row is None:
+                result.append((room_id, None, None, None))
+                continue
+            values = self._row_values(room_id)
+            for i in range(self.horizon):
+                on_date = date.fromordinal(row[1] + i)
+                if not first <= on_date < last or values[i] == NOT_LOADED:
+                    continue
+                db_value = in_db.get((room_id, on_date), NOT_FILLED)
+                if values[i] != db_value:
+                    result.append((room_id, on_date, values[i], db_value))
+        return result
+
+    def _window(self, rooms, start, nights):
+        """
+        Returns {room_id: (min placecount, places)} for rooms with known window
+        """
+        rows = dict()
+        for room_id in rooms:
+            row = self._read_row(room_id)
+            if row is None or row[2] == UNKNOWN_PLACES:
+                continue
+            if start < row[1] or start - row[1] + nights > self.horizon:
+                continue
+            rows[room_id] = row
+        if not rows:
+            return dict()
+        ids = rows.keys()
+        if numpy is not None:
+            data = numpy.frombuffer(self.mm, dtype=numpy.int16, count=self.capacity() * ROW_WORDS,
+                offset=HEADER_SIZE).reshape(-1, ROW_WORDS)
+            starts = numpy.array([DATA_WORDS + start - rows[room_id][1] for room_id in ids])
+            window = data[numpy.array(ids)[:, None], starts[:, None] + numpy.arange(nights)]
+            loaded = (window != NOT_LOADED).all(axis=1)
+            minimal = window.min(axis=1)
+            values = [(int(m), bool(l)) for m, l in zip(minimal, loaded)]
+        else:
+            values = []
+            for room_id in ids:
+                i = start - rows[room_id][1]
+                window = self._row_values(room_id)[i:i + nights]
+                values.append((min(window), NOT_LOADED not in window))
+        result = dict()
+        for room_id, (minimal, loaded) in zip(ids, values):
+            row = self._read_row(room_id)
+            if not loaded or row is None or row[0] != rows[room_id][0] or row[0] % 2:
+                # Row is changed while we read it
+                continue
+            result[room_id] = (minimal, row[2])
+        return result
+
+    def free_rooms(self, rooms, from_date, to_date, roomcount):
+        """
+        Returns (list of free rooms, list of rooms which index can't answer)
+        """
+        start = _ordinal(from_date)
+        nights = _ordinal(to_date) - start
+        unknown = list(rooms)
+        result = []
+        for attempt in range(READ_RETRIES):
+            window = self._window(unknown, start, nights)
+            for room_id, (minimal, places) in window.items():
+                if places > 0 and minimal >= 0 and minimal * places >= roomcount:
+                    result.append(room_id)
+            unknown = [room_id for room_id in unknown if room_id not in window]
+            if not unknown:
+                break
+        return result, unknown
+
+_index = None
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = InventoryIndex()
+    return _index
+
+_deferred = threading.local()
+
+def inventory_update(room_id, placecounts=None, places=None):
+    if not INVENTORY_ENABLED:
+        return
+    changes = getattr(_deferred, 'changes', None)
+    if changes is not None:
+        room = changes.setdefault(room_id, [set(), False])
+        room[0].update([date.fromordinal(_ordinal(d)) for d in (placecounts or dict()).keys()])
+        room[1] = room[1] or places is not None
+        return
+    try:
+        get_index().update(room_id, placecounts, places)
+    except (IOError, OSError):
+        pass
+
+def room_places(room_id):
+    return SettlementVariant.objects.filter(room=room_id, enabled=True).aggregate(
+        places=Max('settlement'))['places'] or 0
+
+def inventory_places_changed(room_id):
+    if not INVENTORY_ENABLED:
+        return
+    inventory_update(room_id, places=room_places(room_id))
+
+def _publish(changes):
+    for room_id, (dates, places_changed) in changes.items():
+        placecounts = dict([(d, None) for d in dates])
+        if dates:
+            placecounts.update(Availability.objects.filter(room=room_id, date__in=list(dates)).values_list(
+                'date', 'placecount'))
+        places = None
+        if places_changed:
+            places = room_places(room_id)
+        try:
+            get_index().update(room_id, placecounts, places)
+        except (IOError, OSError):
+            pass
+
+@contextmanager
+def inventory_after_commit():
+    """
+    Collect inventory_update calls of block and publish them after block,
+    changes are dropped if block raise. Use it around transaction.
+    """
+    outer = getattr(_deferred, 'changes', None)
+    changes = _deferred.changes = dict()
+    try:
+        yield
+    finally:
+        _deferred.changes = outer
+    if outer is None:
+        _publish(changes)
+        return
+    for room_id, (dates, places_changed) in changes.items():
+        room = outer.setdefault(room_id, [set(), False])
+        room[0].update(dates)
+        room[1] = room[1] or places_changed
@@ -1,32 +1,68 @@
 # -*- coding: utf-8 -*-
-from datetime import timedelta, datetime
+from datetime import timedelta, date
+from optparse import make_option
+import json
 from django.conf import settings
+from django.core.mail import get_connection
+from django.db.models import Count
 from django.utils.translation import ugettext as _
 from django.utils.translation import activate
 
 from django.core.management.base import BaseCommand
-from nnmware.apps.booking.models import Hotel, Availability, SettlementVariant
-from nnmware.core.utils import send_template_mail
+from nnmware.apps.booking.models import Hotel, Room, Availability, SettlementVariant, PlacePrice
+from nnmware.core.utils import template_mail_message
+
+CHECK_DAYS = 14
+
+def hotel_info_errors():
+    """
+    Returns list of (hotel, [[room name, error], ...]) for hotels with errors
+    """
+    today = date.today()
+    filled = dict(Availability.objects.filter(date__range=(today, today+timedelta(days=CHECK_DAYS-1))).values(
+        'room').annotate(days=Count('id')).values_list('room', 'days'))
+    with_price = set(PlacePrice.objects.filter(date__lte=today, settlement__enabled=True).values_list(
+        'settlement', flat=True).distinct())
+    not_priced = dict()
+    for settlement_id, room_id, settlement in SettlementVariant.objects.filter(enabled=True).order_by(
+            'pk').values_list('id', 'room', 'settlement'):
+        if settlement_id not in with_price:
+            not_priced.setdefault(room_id, []).append(settlement)
+    rooms = dict()
+    for room in Room.objects.filter(hotel__isnull=False).order_by('pk'):
+        rooms.setdefault(room.hotel_id, []).append(room)
+    result = []
+    for hotel in Hotel.objects.all():
+        errors = []
+        for room in rooms.get(hotel.pk, []):
+            if filled.get(room.pk, 0) < CHECK_DAYS:
+                errors.append([room.get_name, _('Not filled availability')])
+            for settlement in not_priced.get(room.pk, []):
+                errors.append([room.get_name, _('Not filled price for %s-placed settlement') % settlement])
+        if errors:
+            result.append((hotel, errors))
+    return result
 
 class Command(BaseCommand):
     help = 'Check correct info in hotel cabinet'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Print found errors as JSON instead of sending mail'),
+        )
 
     def handle(self, *args, **options):
         activate('ru')
-        for hotel in Hotel.objects.all():
-            result = []
-            for room in hotel.room_set.all():
-                avail = Availability.objects.filter(room=room,date__range=(datetime.now(), datetime.now()+timedelta(days=13))).count()
-                if avail < 14:
-                    avail_err = [room.get_name, _('Not filled availability')]
-                    result.append(avail_err)
-                for settlement in SettlementVariant.objects.filter(room=room, enabled=True):
-                    if settlement.current_amount() is 0:
-                        settlement_err = [room.get_name,_('Not filled price for %s-placed settlement') % settlement.settlement  ]
-                        result.append(settlement_err)
-            if len(result) > 0:
-                recipients = settings.BOOKING_MANAGERS
-                mail_dict = {'hotel_name': hotel.get_name, 'site_name': settings.SITENAME,'items':result}
-                subject = 'booking/err_hotel_subject.txt'
-                body = 'booking/err_hotel.txt'
-                send_template_mail(subject,body,mail_dict,recipients)
+        reports = hotel_info_errors()
+        if options['dry_run']:
+            data = [{'hotel': hotel.pk, 'name': hotel.get_name, 'errors': errors} for hotel, errors in reports]
+            self.stdout.write(json.dumps(data, ensure_ascii=False).encode('utf-8') + '\n')
+            return
+        messages = []
+        for hotel, errors in reports:
+            recipients = settings.BOOKING_MANAGERS
+            mail_dict = {'hotel_name': hotel.get_name, 'site_name': settings.SITENAME,'items':errors}
+            subject = 'booking/err_hotel_subject.txt'
+            body = 'booking/err_hotel.txt'
+            messages.append(template_mail_message(subject,body,mail_dict,recipients))
+        if messages:
+            get_connection().send_messages(messages)
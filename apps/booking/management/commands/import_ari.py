@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from nnmware.apps.booking.ari_import import import_ari, ARI_IMPORT_BATCH, ARI_IMPORT_FORMATS
+from nnmware.apps.money.models import Currency
+
+class Command(BaseCommand):
+    help = 'Import availability, prices and discounts of rooms from CSV or JSON lines feed'
+    args = '<file|->'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+            help='Format of feed: csv or jsonl, default by extension of file'),
+        make_option('--batch', action='store', type='int', dest='batch', default=ARI_IMPORT_BATCH,
+            help='Count of rows written in one batch'),
+        make_option('--currency', action='store', dest='currency', default=None,
+            help='Code of currency of prices, default is DEFAULT_CURRENCY'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+            help='File with offset of last written batch, default is <file>.checkpoint'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+            help='Ignore checkpoint and import file from beginning'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_ari %s' % self.args)
+        path = args[0]
+        file_format = options['format'] or os.path.splitext(path)[1][1:].lower()
+        if file_format == 'json':
+            file_format = 'jsonl'
+        if file_format not in ARI_IMPORT_FORMATS:
+            raise CommandError('Format must be one of %s' % ', '.join(ARI_IMPORT_FORMATS))
+        if options['batch'] < 1:
+            raise CommandError('Batch must be positive')
+        try:
+            currency = Currency.objects.get(code=options['currency'] or settings.DEFAULT_CURRENCY)
+        except Currency.DoesNotExist:
+            raise CommandError('Unknown currency')
+        if path == '-':
+            f, checkpoint = sys.stdin, None
+        else:
+            try:
+                f = open(path, 'rb')
+            except IOError, err:
+                raise CommandError(unicode(err))
+            checkpoint = options['checkpoint'] or path + '.checkpoint'
+        offset = 0
+        if checkpoint is not None and not options['restart'] and os.path.exists(checkpoint):
+            offset = int(open(checkpoint).read().strip() or 0)
+            self.stdout.write('Resume from offset %s\n' % offset)
+        started = time.time()
+
+        def progress(position, stats):
+            if checkpoint is not None:
+                tmp = checkpoint + '.tmp'
+                with open(tmp, 'w') as c:
+                    c.write(str(position))
+                os.rename(tmp, checkpoint)
+            elapsed = max(time.time() - started, 0.001)
+            self.stdout.write('Rows %(rows)s, skipped %(skipped)s, inserted %(inserted)s, updated %(updated)s' %
+                stats + ', %.0f rows/s\n' % (stats['rows'] / elapsed))
+
+        try:
+            stats = import_ari(f, file_format, offset, currency, options['batch'], progress)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        for position, error in stats['errors']:
+            self.stderr.write('Row before offset %s: %s\n' % (position, error))
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write('Imported %s rows in %.1f s\n' % (stats['rows'] - stats['skipped'], time.time() - started))
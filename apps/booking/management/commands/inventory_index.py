@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from nnmware.apps.booking.inventory import get_index
+
+class Command(BaseCommand):
+    help = 'Rebuild shared room inventory index from database or verify it'
+    args = '[rebuild|verify] [room_id ...]'
+
+    def handle(self, *args, **options):
+        if not args or args[0] not in ('rebuild', 'verify'):
+            raise CommandError('Usage: inventory_index %s' % self.args)
+        rooms = [int(r) for r in args[1:]] or None
+        index = get_index()
+        if args[0] == 'rebuild':
+            count = index.rebuild(rooms)
+            self.stdout.write('Rebuilt %s rooms in %s\n' % (count, index.path))
+        else:
+            errors = index.verify(rooms)
+            for room_id, on_date, in_index, in_db in errors:
+                if on_date is None:
+                    self.stdout.write('Room %s is not in index\n' % room_id)
+                else:
+                    self.stdout.write('Room %s on %s: index %s, database %s\n' % (room_id, on_date, in_index, in_db))
+            if errors:
+                raise CommandError('Index differ from database in %s places' % len(errors))
+            self.stdout.write('Index is consistent with database\n')
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from nnmware.apps.booking.rating import reconcile_ratings
+
+class Command(BaseCommand):
+    help = 'Recalculate review sums, averages and histograms of hotels from all reviews'
+    args = '[hotel_id ...]'
+
+    def handle(self, *args, **options):
+        hotels = [int(h) for h in args] or None
+        count = reconcile_ratings(hotels)
+        self.stdout.write('Ratings recalculated for %s hotels\n' % count)
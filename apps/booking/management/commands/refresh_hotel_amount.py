@@ -1,9 +1,55 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from multiprocessing import Pool
+from optparse import make_option
+import time
 from django.core.management.base import BaseCommand, CommandError
-from nnmware.apps.booking.models import Hotel
+from django.db import connection
+from nnmware.apps.booking.models import Hotel, AmountRefreshDate
+from nnmware.apps.booking.prices import refresh_hotel_amounts, mark_amount_dirty
 
 class Command(BaseCommand):
     help = 'Recalculate current minimal hotel amount'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Recalculate all hotels, not only changed'),
+        make_option('--workers', action='store', type='int', dest='workers', default=1,
+            help='Count of worker processes'),
+        make_option('--batch', action='store', type='int', dest='batch', default=500,
+            help='Count of hotels in one aggregate query'),
+        )
 
     def handle(self, *args, **options):
-        for hotel in Hotel.objects.all():
-            hotel.update_hotel_amount()
+        workers, batch = options['workers'], options['batch']
+        if workers < 1 or batch < 1:
+            raise CommandError('Workers and batch must be positive')
+        start = time.time()
+        # Prices with dates after last run become current without any write
+        today = date.today()
+        last_run = AmountRefreshDate.objects.filter(pk=1).values_list('value', flat=True)
+        if not last_run:
+            mark_amount_dirty(room__settlementvariant__placeprice__date__lte=today)
+        elif last_run[0] < today:
+            mark_amount_dirty(room__settlementvariant__placeprice__date__gt=last_run[0],
+                room__settlementvariant__placeprice__date__lte=today)
+        hotels = Hotel.objects.order_by('pk')
+        if not options['all']:
+            hotels = hotels.filter(amount_dirty=True)
+        hotels_id = list(hotels.values_list('pk', flat=True))
+        batches = [hotels_id[i:i + batch] for i in range(0, len(hotels_id), batch)]
+        if workers > 1 and len(batches) > 1:
+            # Every worker must open own database connection
+            connection.close()
+            pool = Pool(workers)
+            try:
+                count = sum(pool.map(refresh_hotel_amounts, batches))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            count = sum([refresh_hotel_amounts(ids) for ids in batches])
+        if not AmountRefreshDate.objects.filter(pk=1).update(value=today):
+            AmountRefreshDate(pk=1, value=today).save()
+        seconds = time.time() - start
+        self.stdout.write('Refreshed %s hotels in %.2f sec (%.1f hotels/sec)\n' %
+            (count, seconds, count / seconds if seconds else 0))
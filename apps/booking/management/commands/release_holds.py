@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from nnmware.apps.booking.holds import release_expired_holds, BOOKING_HOLD_TTL
+
+class Command(BaseCommand):
+    help = 'Return places of expired booking holds'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', action='store', type='int', dest='batch', default=1000,
+            help='Count of holds released in one transaction'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Repeat release every minute'),
+        )
+
+    def handle(self, *args, **options):
+        if options['batch'] < 1:
+            raise CommandError('Batch must be positive')
+        while True:
+            count = release_expired_holds(options['batch'])
+            if count or not options['loop']:
+                self.stdout.write('Released %s holds\n' % count)
+            if not options['loop']:
+                break
+            time.sleep(min(BOOKING_HOLD_TTL, 60))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from nnmware.apps.booking.rollup import backfill_day_stats
+from nnmware.core.utils import convert_to_date
+
+class Command(BaseCommand):
+    help = 'Rebuild daily occupancy and revenue of hotels from bookings and availability'
+    args = '[hotel_id ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--from', action='store', dest='from_date', default=None,
+            help='First date as dd.mm.yyyy, default is 1 January of current year'),
+        make_option('--to', action='store', dest='to_date', default=None,
+            help='Last date as dd.mm.yyyy, default is 31 December of current year'),
+        )
+
+    def handle(self, *args, **options):
+        today = date.today()
+        try:
+            from_date = options['from_date'] and convert_to_date(options['from_date']).date() or date(today.year, 1, 1)
+            to_date = options['to_date'] and convert_to_date(options['to_date']).date() or date(today.year, 12, 31)
+        except ValueError:
+            raise CommandError('Dates must be as dd.mm.yyyy')
+        if from_date > to_date:
+            raise CommandError('First date is after last date')
+        hotels = [int(h) for h in args] or None
+        count = backfill_day_stats(from_date, to_date, hotels)
+        self.stdout.write('Rebuilt %s days of hotels from %s to %s\n' % (count, from_date, to_date))
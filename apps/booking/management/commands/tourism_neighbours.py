@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from nnmware.apps.address.models import Tourism
+from nnmware.apps.address.proximity import fill_geo_cells
+from nnmware.apps.booking.models import Hotel
+from nnmware.apps.booking.tourism import refresh_hotel_tourism
+
+class Command(BaseCommand):
+    help = 'Fill grid cells of hotels and tourism places and rebuild tourism places near hotels'
+    args = '[hotel_id ...]'
+
+    def handle(self, *args, **options):
+        for model in (Hotel, Tourism):
+            count = fill_geo_cells(model)
+            self.stdout.write('Grid cells updated for %s %s\n' % (count, model._meta.verbose_name_plural))
+        hotels = Hotel.objects.all()
+        if args:
+            hotels = hotels.filter(pk__in=[int(h) for h in args])
+        hotels_count, places_count = 0, 0
+        for hotel in hotels.only('pk', 'latitude', 'longitude'):
+            places_count += refresh_hotel_tourism(hotel)
+            hotels_count += 1
+        self.stdout.write('Found %s tourism places near %s hotels\n' % (places_count, hotels_count))
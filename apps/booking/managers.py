@@ -1,6 +1,55 @@
+from datetime import date
+from decimal import Decimal
 from django.db.models.manager import Manager
 
 class SettlementVariantManager(Manager):
 
     def get_query_set(self):
         return super(SettlementVariantManager, self).get_query_set().filter(enabled=True).order_by('settlement')
+
+
+MIN_CURRENT_SQL = """SELECT MIN(p.amount) FROM %(price)s p
+    INNER JOIN %(settlement)s s ON s.id = p.settlement_id
+    INNER JOIN %(room)s r ON r.id = s.room_id
+    WHERE %(owner)s = %(table)s.id AND s.enabled = %%s AND p.amount > 0
+        AND p.date = (SELECT MAX(p2.date) FROM %(price)s p2
+            WHERE p2.settlement_id = p.settlement_id AND p2.date <= %%s)"""
+
+HAS_SETTLEMENT_SQL = """SELECT 1 FROM %(settlement)s s
+    INNER JOIN %(room)s r ON r.id = s.room_id
+    WHERE %(owner)s = %(table)s.id AND s.enabled = %%s"""
+
+
+def as_amount(value):
+    # Some backends return extra select over decimal column as float
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+class MinCurrentAmountManager(Manager):
+    owner_column = None
+
+    def with_min_current_amount(self, on_date=None):
+        """
+        Annotate min_current_price: minimal positive current price of enabled
+        settlements, 0 if no positive price and None without enabled settlements
+        """
+        from nnmware.apps.booking.models import Room, SettlementVariant, PlacePrice
+        tables = {'price': PlacePrice._meta.db_table,
+                  'settlement': SettlementVariant._meta.db_table,
+                  'room': Room._meta.db_table,
+                  'table': self.model._meta.db_table,
+                  'owner': self.owner_column}
+        select = "COALESCE((%s), CASE WHEN EXISTS (%s) THEN 0 END)" % (MIN_CURRENT_SQL % tables,
+            HAS_SETTLEMENT_SQL % tables)
+        return self.get_query_set().extra(select={'min_current_price': select},
+            select_params=[True, on_date or date.today(), True])
+
+
+class HotelManager(MinCurrentAmountManager):
+    owner_column = 'r.hotel_id'
+
+
+class RoomManager(MinCurrentAmountManager):
+    owner_column = 'r.id'
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime, timedelta
-from decimal import Decimal
 from uuid import uuid4
-import random
 from django.db import models
 from django.conf import settings
-from django.db.models import permalink, signals, Avg
+from django.db.models import permalink, signals
 from django.db.models.manager import Manager
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation.trans_real import get_language
@@ -15,7 +13,8 @@ from nnmware.core.models import Pic
 from nnmware.apps.money.models import MoneyBase
 from nnmware.apps.address.models import Tourism
 from nnmware.core.abstract import MetaIP, MetaName
-from nnmware.core.maps import places_near_object
+from nnmware.apps.booking.allocator import allocate_system_id
+from nnmware.apps.booking.managers import HotelManager, RoomManager, as_amount
 
 class HotelPoints(models.Model):
     food = models.DecimalField(verbose_name=_('Food'), default=0, decimal_places=1, max_digits=4)
@@ -136,6 +135,15 @@ class Hotel(MetaName, MetaGeo, HotelPoints):
     best_offer = models.BooleanField(verbose_name=_("Best offer"), default=False)
     in_top10 = models.BooleanField(verbose_name=_("In top 10"), default=False)
     current_amount = models.DecimalField(verbose_name=_('Current amount'), default=0, max_digits=20, decimal_places=3)
+    amount_dirty = models.BooleanField(verbose_name=_('Current amount need refresh'), default=True, editable=False)
+    ari_updated_date = models.DateTimeField(_("Availability and rates updated date"), null=True, blank=True, editable=False)
+    tourism_updated_date = models.DateTimeField(_("Tourism places updated date"), null=True, blank=True, editable=False)
+    review_count = models.IntegerField(_("Count of reviews"), null=True, default=None, editable=False)
+    food_sum = models.DecimalField(verbose_name=_('Sum of food points'), default=0, decimal_places=1, max_digits=12, editable=False)
+    service_sum = models.DecimalField(verbose_name=_('Sum of service points'), default=0, decimal_places=1, max_digits=12, editable=False)
+    purity_sum = models.DecimalField(verbose_name=_('Sum of purity points'), default=0, decimal_places=1, max_digits=12, editable=False)
+    transport_sum = models.DecimalField(verbose_name=_('Sum of transport points'), default=0, decimal_places=1, max_digits=12, editable=False)
+    prices_sum = models.DecimalField(verbose_name=_('Sum of prices points'), default=0, decimal_places=1, max_digits=12, editable=False)
     booking_terms = models.TextField(verbose_name=_("Booking terms"), blank=True, null=True)
     schema_transit = models.TextField(verbose_name=_("Schema of transit"), blank=True, null=True)
     booking_terms_en = models.TextField(verbose_name=_("Booking terms(English)"), blank=True, null=True)
@@ -153,7 +161,7 @@ class Hotel(MetaName, MetaGeo, HotelPoints):
         verbose_name_plural = _("Hotels")
         ordering = ("name",)
 
-    objects = Manager()
+    objects = HotelManager()
 
     def get_address(self):
         if get_language() == 'en':
@@ -199,55 +207,43 @@ class Hotel(MetaName, MetaGeo, HotelPoints):
         return "cabinet_info", (), {'city':self.city.slug ,'slug': self.slug}
 
     def get_current_percent(self):
+        from nnmware.apps.booking.commission import percent_index
         try:
-            return AgentPercent.objects.filter(hotel=self).filter(date__lte=datetime.now()).order_by('-date')[0].percent
+            return percent_index(self).percent_on_date(datetime.now())
         except IndexError:
             return None
 
     def get_percent_on_date(self, date):
-        return AgentPercent.objects.filter(hotel=self).filter(date__lte=date).order_by('-date')[0].percent
+        from nnmware.apps.booking.commission import percent_index
+        return percent_index(self).percent_on_date(date)
+
+    def get_percents_on_dates(self, from_date, to_date):
+        # Percent for every night in [from_date, to_date), IndexError if no percent on some night
+        from nnmware.apps.booking.commission import percent_index
+        return percent_index(self).percents_on_dates(from_date, to_date)
 
     def free_room(self, from_date, to_date, roomcount):
-        result = []
-        for room in self.room_set.all():
-            check_date = from_date
-            avail = None
-            while check_date < to_date:
-                places = room.date_place_count(check_date)
-                if places < roomcount:
-                    avail = None
-                    break
-                avail = 1
-                check_date +=timedelta(days=1)
-            if avail:
-                result.append(room)
-        return result
+        from nnmware.apps.booking.availability import free_rooms
+        rooms_id = free_rooms([self.pk], from_date, to_date, roomcount).get(self.pk, [])
+        if not rooms_id:
+            return []
+        return list(self.room_set.filter(pk__in=rooms_id))
 
 
     @property
     def min_current_amount(self):
-        rooms = Room.objects.filter(hotel=self)
-        result = None
-        for r in rooms:
-            min_price = r.min_current_amount
-            if not result:
-                result = min_price
-            else:
-                if result > min_price > 0:
-                    result = min_price
-        return result
+        if not hasattr(self, 'min_current_price'):
+            self.min_current_price = Hotel.objects.with_min_current_amount().get(pk=self.pk).min_current_price
+        return as_amount(self.min_current_price)
 
     def amount_on_date(self, date):
-        rooms = Room.objects.filter(hotel=self)
-        result = None
-        for r in rooms:
-            min_price = r.amount_on_date(date)
-            if not result:
-                result = min_price
-            else:
-                if result > min_price:
-                    result = min_price
-        return result
+        from nnmware.apps.booking.prices import price_matrix, min_amount
+        settlements = SettlementVariant.objects.filter(room__hotel=self, enabled=True).values_list('id', 'room')
+        prices = price_matrix([s for s, room in settlements], date, date+timedelta(days=1))
+        rooms = dict()
+        for s, room in settlements:
+            rooms.setdefault(room, []).append(prices.row(s)[0])
+        return min_amount([min_amount(rooms.get(r, [])) for r in Room.objects.filter(hotel=self).values_list('id', flat=True)])
 
 
     def save(self, *args, **kwargs):
@@ -263,20 +259,22 @@ class Hotel(MetaName, MetaGeo, HotelPoints):
         super(Hotel, self).save(*args, **kwargs)
 
     def update_hotel_amount(self):
-        amount = self.min_current_amount
-        if amount:
-            self.current_amount = amount
-        else:
-            self.current_amount = 0
-        self.save()
+        from nnmware.apps.booking.prices import refresh_hotel_amounts
+        refresh_hotel_amounts([self.pk])
 
     def tourism_places(self):
-        places = Tourism.objects.raw(places_near_object(self,settings.TOURISM_PLACES_RADIUS,
-            'address_tourism'))
-        all_places = []
-        for p in places:
-            all_places.append(p.id)
-        return Tourism.objects.filter(pk__in=all_places).order_by('category')
+        """
+        Tourism places near hotel, nearest first, distance in km is in distance attribute
+        """
+        from nnmware.apps.booking.tourism import refresh_hotel_tourism
+        if self.tourism_updated_date is None:
+            refresh_hotel_tourism(self)
+        result = []
+        for near in HotelTourism.objects.filter(hotel=self).select_related('tourism',
+                'tourism__category').order_by('distance'):
+            near.tourism.distance = near.distance
+            result.append(near.tourism)
+        return result
 
     def complete_booking_users_id(self):
         # TODO Check status of bookings
@@ -339,7 +337,7 @@ class Room(MetaName):
         verbose_name = _("Room")
         verbose_name_plural = _("Rooms")
 
-    objects = Manager()
+    objects = RoomManager()
 
     def __unicode__(self):
         try:
@@ -349,31 +347,19 @@ class Room(MetaName):
 
     @property
     def min_current_amount(self):
-        settlements = SettlementVariant.objects.filter(room=self, enabled=True)
-        result = None
-        for s in settlements:
-            s_min_price = s.current_amount()
-            if not result:
-                result = s_min_price
-            else:
-                if result > s_min_price:
-                    result = s_min_price
-        return result
+        if not hasattr(self, 'min_current_price'):
+            self.min_current_price = Room.objects.with_min_current_amount().get(pk=self.pk).min_current_price
+        return as_amount(self.min_current_price)
 
     def amount_on_date(self, date, guests=None):
+        from nnmware.apps.booking.prices import price_matrix, min_amount
         if guests:
             settlements = SettlementVariant.objects.filter(room=self, enabled=True, settlement=guests)
         else:
             settlements = SettlementVariant.objects.filter(room=self, enabled=True)
-        result = None
-        for s in settlements:
-            s_min_price = s.amount_on_date(date)
-            if not result:
-                result = s_min_price
-            else:
-                if result > s_min_price:
-                    result = s_min_price
-        return result
+        settlements = list(settlements.values_list('id', flat=True))
+        prices = price_matrix(settlements, date, date+timedelta(days=1))
+        return min_amount([prices.row(s)[0] for s in settlements])
 
     def discount_on_date(self, date):
         try:
@@ -381,7 +367,7 @@ class Room(MetaName):
         except :
             return None
 
-    def amount_on_date_guest_variant(self, date, guests):
+    def settlement_for_guests(self, guests):
         # Find all settlement variants for room
         try:
             s = SettlementVariant.objects.filter(room=self, enabled=True, settlement=guests)[0]
@@ -392,6 +378,10 @@ class Room(MetaName):
             except :
                 s = SettlementVariant.objects.filter(room=self,
                     enabled=True, settlement__lte=guests).order_by('-settlement')[0]
+        return s
+
+    def amount_on_date_guest_variant(self, date, guests):
+        s = self.settlement_for_guests(guests)
         return s.amount_on_date(date),s.settlement
 
     def active_settlements(self):
@@ -472,7 +462,7 @@ STATUS_CHOICES = (
 class Booking(MoneyBase, MetaIP):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('User'), blank=True, null=True)
     date = models.DateTimeField(verbose_name=_("Creation date"), default=datetime.now)
-    system_id = models.IntegerField(_("ID in system"), default=0)
+    system_id = models.IntegerField(_("ID in system"), default=0, unique=True)
     from_date = models.DateField(_("From"))
     to_date = models.DateField(_("To"))
     settlement = models.ForeignKey(SettlementVariant, verbose_name=_('Settlement Variant'), null=True, on_delete=models.SET_NULL)
@@ -522,17 +512,90 @@ class Booking(MoneyBase, MetaIP):
         delta = self.to_date-self.from_date
         return delta.days
 
+    def __init__(self, *args, **kwargs):
+        super(Booking, self).__init__(*args, **kwargs)
+        self._saved_stat = self.stat_values()
+
+    def stat_values(self):
+        # Fields of booking used in HotelDayStat
+        return tuple([self.__dict__.get(f) for f in ('hotel_id', 'status', 'from_date', 'to_date',
+                                                     'amount', 'commission')])
+
     def save(self, *args, **kwargs):
         if not self.uuid:
             self.uuid = uuid4()
         if self.system_id < 1:
-            new_id = random.randint(100000000, 999999999)
-            while Booking.objects.filter(system_id=new_id).count() > 0:
-                new_id = random.randint(100000000, 999999999)
-            self.system_id = new_id
+            self.system_id = allocate_system_id()
         super(Booking, self).save(*args, **kwargs)
 
 
+class HotelDayStat(models.Model):
+    hotel = models.ForeignKey(Hotel)
+    date = models.DateField(verbose_name=_("On date"), db_index=True)
+    sold = models.IntegerField(verbose_name=_('Sold room-nights'), default=0)
+    remaining = models.IntegerField(verbose_name=_('Remaining places'), default=0)
+    revenue = models.DecimalField(verbose_name=_('Revenue'), default=0, max_digits=20, decimal_places=3)
+    commission = models.DecimalField(verbose_name=_('Commission'), default=0, max_digits=20, decimal_places=3)
+
+    class Meta:
+        unique_together = (('hotel', 'date'),)
+        verbose_name = _("Hotel day statistic")
+        verbose_name_plural = _("Hotel day statistics")
+
+    @property
+    def adr(self):
+        if self.sold:
+            return self.revenue/self.sold
+        return 0
+
+
+class BookingHold(models.Model):
+    session_key = models.CharField(verbose_name=_("Session key"), max_length=40, db_index=True)
+    room = models.ForeignKey(Room, verbose_name=_('Room'))
+    settlement = models.ForeignKey(SettlementVariant, verbose_name=_('Settlement Variant'))
+    from_date = models.DateField(_("From"))
+    to_date = models.DateField(_("To"))
+    roomcount = models.IntegerField(verbose_name=_('Count of rooms'), default=1)
+    amount = models.DecimalField(verbose_name=_('Amount'), default=0, max_digits=20, decimal_places=3)
+    commission = models.DecimalField(verbose_name=_('Commission'), default=0, max_digits=20, decimal_places=3)
+    created_date = models.DateTimeField(verbose_name=_("Creation date"), default=datetime.now)
+    expire_date = models.DateTimeField(verbose_name=_("Expire date"), db_index=True)
+
+    class Meta:
+        verbose_name = _("Booking hold")
+        verbose_name_plural = _("Booking holds")
+
+    def __unicode__(self):
+        return u"Hold of room %s from %s to %s" % (self.room_id, self.from_date, self.to_date)
+
+
+class BookingSequence(models.Model):
+    value = models.BigIntegerField(verbose_name=_('Last reserved value'), default=0)
+
+    class Meta:
+        verbose_name = _("Booking sequence")
+        verbose_name_plural = _("Booking sequences")
+
+
+class AmountRefreshDate(models.Model):
+    value = models.DateField(verbose_name=_('Last refresh date'))
+
+    class Meta:
+        verbose_name = _("Date of current amount refresh")
+        verbose_name_plural = _("Dates of current amount refresh")
+
+
+class HotelTourism(models.Model):
+    hotel = models.ForeignKey(Hotel)
+    tourism = models.ForeignKey(Tourism)
+    distance = models.FloatField(verbose_name=_("Distance, km"), default=0)
+
+    class Meta:
+        verbose_name = _("Tourism place near hotel")
+        verbose_name_plural = _("Tourism places near hotels")
+        ordering = ("distance",)
+
+
 class AgentPercent(models.Model):
     hotel = models.ForeignKey(Hotel)
     date = models.DateField(verbose_name=_("From date"))
@@ -562,12 +625,29 @@ class Review(MetaIP, HotelPoints):
         verbose_name = _("Client review")
         verbose_name_plural = _("Client reviews")
 
+    def __init__(self, *args, **kwargs):
+        super(Review, self).__init__(*args, **kwargs)
+        self._saved_hotel_id = self.__dict__.get('hotel_id')
+        self._saved_points = dict([(c, self.__dict__.get(c)) for c in ('food', 'service', 'purity', 'transport', 'prices')])
+
     def __unicode__(self):
         return _("Review client %(client)s for hotel %(hotel)s is -> %(review)s") % \
                { 'client': self.user.get_full_name(),
                  'hotel': self.hotel.name,
                  'review': self.review }
 
+
+class ReviewHistogram(models.Model):
+    hotel = models.ForeignKey(Hotel)
+    criterion = models.CharField(verbose_name=_("Criterion"), max_length=20)
+    point = models.IntegerField(verbose_name=_("Point"), default=0)
+    count = models.IntegerField(verbose_name=_("Count of reviews"), default=0)
+
+    class Meta:
+        unique_together = (('hotel', 'criterion', 'point'),)
+        verbose_name = _("Histogram of review points")
+        verbose_name_plural = _("Histograms of review points")
+
 class Availability(models.Model):
     room = models.ForeignKey(Room, verbose_name=_('Room'), null=True, blank=True, on_delete=models.SET_NULL)
     date = models.DateField(verbose_name=_("On date"))
@@ -639,21 +719,137 @@ class RequestAddHotel(MetaIP):
         verbose_name_plural = _("Requests for add hotels")
         ordering = ("-pk",)
 
-def update_hotel_point(sender, instance, **kwargs):
-    hotel = instance.hotel
-    all_points = Review.objects.filter(hotel=hotel).aggregate(Avg('food'), Avg('service'),
-        Avg('purity'), Avg('transport'), Avg('prices'))
-    hotel.food = Decimal(str(all_points['food__avg'])).quantize(Decimal('1.0'))
-    hotel.service = Decimal(str(all_points['service__avg'])).quantize(Decimal('1.0'))
-    hotel.purity = Decimal(str(all_points['purity__avg'])).quantize(Decimal('1.0'))
-    hotel.transport = Decimal(str(all_points['transport__avg'])).quantize(Decimal('1.0'))
-    hotel.prices = Decimal(str(all_points['prices__avg'])).quantize(Decimal('1.0'))
-    h_point = (hotel.food+hotel.service+hotel.purity+hotel.transport+hotel.prices)/5
-    hotel.point = h_point
-    hotel.save()
+def review_saved(sender, instance, created, **kwargs):
+    from nnmware.apps.booking.rating import change_rating, review_points
+    points = review_points(instance)
+    if not created and instance._saved_hotel_id == instance.hotel_id and instance._saved_points == points:
+        return
+    applied = True
+    if not created:
+        applied = change_rating(instance._saved_hotel_id, instance._saved_points, -1)
+    if applied or instance._saved_hotel_id != instance.hotel_id:
+        # Unless old hotel is same and was recalculated with saved review
+        change_rating(instance.hotel_id, points, 1)
+    instance._saved_hotel_id = instance.hotel_id
+    instance._saved_points = points
+
+def review_deleted(sender, instance, **kwargs):
+    from nnmware.apps.booking.rating import change_rating
+    change_rating(instance._saved_hotel_id, instance._saved_points, -1)
+
+
+signals.post_save.connect(review_saved, sender=Review, dispatch_uid="nnmware_id")
+signals.post_delete.connect(review_deleted, sender=Review, dispatch_uid="nnmware_id")
+
+
+
+def placeprice_amount_dirty(sender, instance, **kwargs):
+    from nnmware.apps.booking.prices import mark_amount_dirty
+    mark_amount_dirty(room__settlementvariant__id=instance.settlement_id)
+
+def settlement_amount_dirty(sender, instance, **kwargs):
+    from nnmware.apps.booking.prices import mark_amount_dirty
+    mark_amount_dirty(room__id=instance.room_id)
+
+
+signals.post_save.connect(placeprice_amount_dirty, sender=PlacePrice, dispatch_uid="nnmware_amount_dirty")
+signals.post_delete.connect(placeprice_amount_dirty, sender=PlacePrice, dispatch_uid="nnmware_amount_dirty")
+signals.post_save.connect(settlement_amount_dirty, sender=SettlementVariant, dispatch_uid="nnmware_amount_dirty")
+signals.post_delete.connect(settlement_amount_dirty, sender=SettlementVariant, dispatch_uid="nnmware_amount_dirty")
+
+def hotel_ari_changed(**filters):
+    from nnmware.apps.booking.search import bump_search_version
+    hotels = Hotel.objects.filter(**filters)
+    hotels.update(ari_updated_date=datetime.now())
+    bump_search_version(hotels.values_list('city', flat=True).distinct())
+
+def room_ari_changed(sender, instance, **kwargs):
+    hotel_ari_changed(room__id=instance.room_id)
+
+def placeprice_ari_changed(sender, instance, **kwargs):
+    hotel_ari_changed(room__settlementvariant__id=instance.settlement_id)
+
+
+signals.post_save.connect(room_ari_changed, sender=Availability, dispatch_uid="nnmware_ari_changed")
+signals.post_delete.connect(room_ari_changed, sender=Availability, dispatch_uid="nnmware_ari_changed")
+signals.post_save.connect(room_ari_changed, sender=Discount, dispatch_uid="nnmware_ari_changed")
+signals.post_delete.connect(room_ari_changed, sender=Discount, dispatch_uid="nnmware_ari_changed")
+signals.post_save.connect(placeprice_ari_changed, sender=PlacePrice, dispatch_uid="nnmware_ari_changed")
+signals.post_delete.connect(placeprice_ari_changed, sender=PlacePrice, dispatch_uid="nnmware_ari_changed")
+
+def availability_inventory_saved(sender, instance, **kwargs):
+    from nnmware.apps.booking.inventory import inventory_update
+    inventory_update(instance.room_id, {instance.date: instance.placecount})
+
+def availability_inventory_deleted(sender, instance, **kwargs):
+    from nnmware.apps.booking.inventory import inventory_update
+    inventory_update(instance.room_id, {instance.date: None})
+
+def settlement_inventory_changed(sender, instance, **kwargs):
+    from nnmware.apps.booking.inventory import inventory_places_changed
+    inventory_places_changed(instance.room_id)
+
+
+signals.post_save.connect(availability_inventory_saved, sender=Availability, dispatch_uid="nnmware_inventory")
+signals.post_delete.connect(availability_inventory_deleted, sender=Availability, dispatch_uid="nnmware_inventory")
+signals.post_save.connect(settlement_inventory_changed, sender=SettlementVariant, dispatch_uid="nnmware_inventory")
+signals.post_delete.connect(settlement_inventory_changed, sender=SettlementVariant, dispatch_uid="nnmware_inventory")
+
+def agentpercent_changed(sender, instance, **kwargs):
+    from nnmware.apps.booking.commission import clear_percent_index
+    clear_percent_index(instance.hotel_id)
+
+
+signals.post_save.connect(agentpercent_changed, sender=AgentPercent, dispatch_uid="nnmware_agent_percent")
+signals.post_delete.connect(agentpercent_changed, sender=AgentPercent, dispatch_uid="nnmware_agent_percent")
+
+def hotel_search_changed(sender, instance, **kwargs):
+    from nnmware.apps.booking.search import bump_search_version
+    bump_search_version([instance.city_id])
+
+def hotel_option_search_changed(sender, instance, reverse, pk_set, **kwargs):
+    from nnmware.apps.booking.search import bump_search_version
+    if not reverse:
+        bump_search_version([instance.city_id])
+    elif pk_set:
+        bump_search_version(Hotel.objects.filter(pk__in=pk_set).values_list('city', flat=True).distinct())
+
+
+signals.post_save.connect(hotel_search_changed, sender=Hotel, dispatch_uid="nnmware_search_version")
+signals.post_delete.connect(hotel_search_changed, sender=Hotel, dispatch_uid="nnmware_search_version")
+signals.m2m_changed.connect(hotel_option_search_changed, sender=Hotel.option.through, dispatch_uid="nnmware_search_version")
+
+def hotel_moved(sender, instance, **kwargs):
+    if getattr(instance, 'moved', False):
+        from nnmware.apps.booking.tourism import refresh_hotel_tourism
+        refresh_hotel_tourism(instance)
+
+def tourism_moved(sender, instance, **kwargs):
+    if getattr(instance, 'moved', False):
+        from nnmware.apps.booking.tourism import refresh_tourism_hotels
+        refresh_tourism_hotels(instance)
+
+
+signals.post_save.connect(hotel_moved, sender=Hotel, dispatch_uid="nnmware_tourism_neighbours")
+signals.post_save.connect(tourism_moved, sender=Tourism, dispatch_uid="nnmware_tourism_neighbours")
+
+def booking_stat_saved(sender, instance, **kwargs):
+    from nnmware.apps.booking.rollup import change_booking_stat
+    values = instance.stat_values()
+    if values != instance._saved_stat:
+        change_booking_stat(instance._saved_stat, values)
+        instance._saved_stat = values
 
+def booking_stat_deleted(sender, instance, **kwargs):
+    from nnmware.apps.booking.rollup import change_booking_stat
+    change_booking_stat(instance._saved_stat, None)
 
-signals.post_save.connect(update_hotel_point, sender=Review, dispatch_uid="nnmware_id")
-signals.post_delete.connect(update_hotel_point, sender=Review, dispatch_uid="nnmware_id")
+def availability_stat_changed(sender, instance, **kwargs):
+    from nnmware.apps.booking.rollup import refresh_remaining
+    refresh_remaining(room__id=instance.room_id, dates=[instance.date])
 
 
+signals.post_save.connect(booking_stat_saved, sender=Booking, dispatch_uid="nnmware_day_stat")
+signals.post_delete.connect(booking_stat_deleted, sender=Booking, dispatch_uid="nnmware_day_stat")
+signals.post_save.connect(availability_stat_changed, sender=Availability, dispatch_uid="nnmware_day_stat")
+signals.post_delete.connect(availability_stat_changed, sender=Availability, dispatch_uid="nnmware_day_stat")
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from nnmware.apps.booking.models import Hotel, PlacePrice
+from nnmware.apps.booking.managers import as_amount
+from nnmware.apps.booking.availability import as_date
+from nnmware.apps.booking.search import bump_search_version
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AS_OF_WHERE = """%(table)s.date >= COALESCE((SELECT MAX(p.date) FROM %(table)s p
+    WHERE p.settlement_id = %(table)s.settlement_id AND p.date <= %%s), %%s)"""
+
+
+class PriceMatrix(object):
+    """
+    Prices of settlements for every night in [from_date, to_date).
+    Price on night is amount of latest PlacePrice with date <= night
+    or 0, same as SettlementVariant.amount_on_date.
+    """
+
+    def __init__(self, settlements, from_date, to_date):
+        self.from_date = as_date(from_date)
+        self.to_date = as_date(to_date)
+        self.settlements = [getattr(s, 'pk', s) for s in settlements]
+        self.dates = [self.from_date + timedelta(days=i) for i in range((self.to_date - self.from_date).days)]
+        self.rows = dict()
+        self._load()
+
+    def _load(self):
+        history = dict()
+        if self.settlements and self.dates:
+            table = PlacePrice._meta.db_table
+            prices = PlacePrice.objects.filter(settlement__in=self.settlements, date__lt=self.to_date).extra(
+                where=[AS_OF_WHERE % {'table': table}], params=[self.from_date, self.from_date]).order_by(
+                'settlement', 'date').values_list('settlement', 'date', 'amount')
+            for settlement_id, on_date, amount in prices:
+                history.setdefault(settlement_id, ([], []))
+                history[settlement_id][0].append(on_date.toordinal())
+                history[settlement_id][1].append(amount)
+        nights = [d.toordinal() for d in self.dates]
+        for settlement_id in self.settlements:
+            dates, amounts = history.get(settlement_id, ([], []))
+            self.rows[settlement_id] = forward_fill(dates, amounts, nights)
+
+    def row(self, settlement):
+        return self.rows[getattr(settlement, 'pk', settlement)]
+
+    def price(self, settlement, on_date):
+        return self.row(settlement)[(as_date(on_date) - self.from_date).days]
+
+    def total(self, settlement):
+        return sum(self.row(settlement))
+
+
+def forward_fill(dates, amounts, nights):
+    """
+    For sorted dates of prices returns amount of latest price date <= night for every night
+    """
+    if not dates:
+        return [0] * len(nights)
+    if numpy is not None:
+        positions = numpy.searchsorted(numpy.array(dates), numpy.array(nights), side='right') - 1
+        values = numpy.array(amounts + [0], dtype=object)
+        return values[positions].tolist()
+    result = []
+    i = -1
+    for night in nights:
+        while i + 1 < len(dates) and dates[i + 1] <= night:
+            i += 1
+        if i < 0:
+            result.append(0)
+        else:
+            result.append(amounts[i])
+    return result
+
+def price_matrix(settlements, from_date, to_date):
+    return PriceMatrix(settlements, from_date, to_date)
+
+def min_amount(values):
+    """
+    Minimum as in Room.min_current_amount loops: empty result is replaced by next value
+    """
+    result = None
+    for value in values:
+        if not result:
+            result = value
+        else:
+            if result > value:
+                result = value
+    return result
+
+def hotels_min_current_amount(hotels_id, on_date=None):
+    """
+    Returns {hotel_id: minimal positive current price of enabled settlements}
+    with one query. Hotels without prices are not in result.
+    """
+    result = dict()
+    if not hotels_id:
+        return result
+    for hotel_id, amount in Hotel.objects.with_min_current_amount(on_date).filter(
+            pk__in=hotels_id).values_list('pk', 'min_current_price'):
+        amount = as_amount(amount)
+        if amount:
+            result[hotel_id] = amount
+    return result
+
+def refresh_hotel_amounts(hotels_id):
+    """
+    Recalculate Hotel.current_amount for hotels, rows with same amount
+    updated by one query. Dirty mark is cleared before calculation, so
+    price changed while we work mark hotel again.
+    """
+    hotels_id = list(hotels_id)
+    if not hotels_id:
+        return 0
+    Hotel.objects.filter(pk__in=hotels_id).update(amount_dirty=False)
+    old_amounts = dict([(pk, (amount, city_id)) for pk, amount, city_id in Hotel.objects.filter(
+        pk__in=hotels_id).values_list('pk', 'current_amount', 'city')])
+    amounts = hotels_min_current_amount(hotels_id)
+    by_amount = dict()
+    changed_cities = set()
+    for hotel_id in hotels_id:
+        amount = amounts.get(hotel_id, 0)
+        by_amount.setdefault(amount, []).append(hotel_id)
+        if hotel_id in old_amounts and old_amounts[hotel_id][0] != amount:
+            changed_cities.add(old_amounts[hotel_id][1])
+    for amount, ids in by_amount.items():
+        Hotel.objects.filter(pk__in=ids).update(current_amount=amount)
+    if changed_cities:
+        # Search results sorted by amount are cached
+        bump_search_version(changed_cities)
+    return len(hotels_id)
+
+def mark_amount_dirty(**filters):
+    Hotel.objects.filter(**filters).update(amount_dirty=True)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from nnmware.apps.booking.models import SettlementVariant
+from nnmware.apps.booking.availability import as_date
+from nnmware.apps.booking.prices import price_matrix
+
+
+def settlement_for_guests(settlements, guests):
+    """
+    Choose settlement as Room.settlement_for_guests from list of
+    (settlement_id, settlement) of enabled settlements of room
+    """
+    if guests is None or not settlements:
+        return None
+    exact = [s for s in settlements if s[1] == guests]
+    if exact:
+        return exact[0]
+    bigger = sorted([s for s in settlements if s[1] > guests], key=lambda s: s[1])
+    if bigger:
+        return bigger[0]
+    return sorted(settlements, key=lambda s: s[1])[-1]
+
+
+class StayQuote(object):
+    """
+    Price of stay in room for guests: chosen settlement, nightly prices, total and average
+    """
+
+    def __init__(self, room_id, settlement_id, settlement, dates, prices):
+        self.room_id = room_id
+        self.settlement_id = settlement_id
+        self.settlement = settlement
+        self.dates = dates
+        self.prices = prices
+        self.nights = len(prices)
+        self.total = sum(prices)
+        if self.nights:
+            self.average = self.total/self.nights
+        else:
+            self.average = 0
+
+    def nightly(self):
+        return zip(self.dates, self.prices)
+
+
+def hotel_quotes(hotel_id, from_date, to_date, guests):
+    """
+    Returns {room_id: StayQuote} for all rooms of hotel with two queries
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    settlements = dict()
+    for settlement_id, room_id, settlement in SettlementVariant.objects.filter(room__hotel=hotel_id,
+            enabled=True).order_by('pk').values_list('id', 'room', 'settlement'):
+        settlements.setdefault(room_id, []).append((settlement_id, settlement))
+    chosen = dict()
+    for room_id, variants in settlements.items():
+        s = settlement_for_guests(variants, guests)
+        if s is not None:
+            chosen[room_id] = s
+    prices = price_matrix([s[0] for s in chosen.values()], from_date, to_date)
+    result = dict()
+    for room_id, (settlement_id, settlement) in chosen.items():
+        result[room_id] = StayQuote(room_id, settlement_id, settlement, prices.dates, prices.row(settlement_id))
+    return result
+
+def stay_quote(request, room, from_date, to_date, guests):
+    """
+    StayQuote of room, quotes of all rooms of hotel memoized on request
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    memo = getattr(request, '_stay_quotes', None)
+    if memo is None:
+        memo = request._stay_quotes = dict()
+    key = (room.hotel_id, from_date, to_date, guests)
+    if key not in memo:
+        memo[key] = hotel_quotes(room.hotel_id, from_date, to_date, guests)
+    return memo[key].get(room.pk)
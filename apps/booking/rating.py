@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Rating of hotels kept as sums of review points and count of reviews,
+changed by atomic updates on every save and delete of review. Averages
+of hotel calculated from sums, histogram keep count of reviews for every
+point of criterion. Sums of hotel which were never filled (review_count
+is NULL) are counted from all reviews on first change.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import transaction, IntegrityError
+from django.db.models import F, Count, Sum
+from nnmware.apps.booking.models import Hotel, Review, ReviewHistogram
+from nnmware.apps.booking.search import bump_search_version
+from nnmware.core.utils import commit_on_success_unless_managed
+
+CRITERIA = ('food', 'service', 'purity', 'transport', 'prices')
+
+
+def review_points(review):
+    return dict([(c, getattr(review, c)) for c in CRITERIA])
+
+def histogram_point(value):
+    return int(Decimal(str(value)).quantize(Decimal('1'), ROUND_HALF_UP))
+
+def _change_histogram(hotel_id, criterion, point, delta):
+    bucket = ReviewHistogram.objects.filter(hotel=hotel_id, criterion=criterion, point=point)
+    if bucket.update(count=F('count') + delta) or delta < 0:
+        return
+    try:
+        sid = transaction.savepoint()
+        ReviewHistogram(hotel_id=hotel_id, criterion=criterion, point=point, count=delta).save()
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Created by concurrent review
+        transaction.savepoint_rollback(sid)
+        bucket.update(count=F('count') + delta)
+
+def refresh_hotel_points(hotel_id):
+    """
+    Averages and point of hotel from sums, rounded as before
+    """
+    sums = Hotel.objects.filter(pk=hotel_id).values('city', 'point', 'review_count',
+        *['%s_sum' % c for c in CRITERIA])
+    if not sums or sums[0]['review_count'] is None:
+        return
+    sums = sums[0]
+    values = dict()
+    for c in CRITERIA:
+        if sums['review_count'] > 0:
+            values[c] = (Decimal(str(sums['%s_sum' % c])) / sums['review_count']).quantize(Decimal('1.0'))
+        else:
+            values[c] = Decimal(0)
+    values['point'] = sum([values[c] for c in CRITERIA]) / 5
+    Hotel.objects.filter(pk=hotel_id).update(**values)
+    if values['point'] != sums['point']:
+        # Search results sorted by point are cached
+        bump_search_version([sums['city']])
+
+def change_rating(hotel_id, points, sign):
+    """
+    Add (sign=1) or remove (sign=-1) points of one review. Returns False
+    if sums were not filled and recalculated from reviews instead.
+    """
+    if hotel_id is None:
+        return True
+    points = dict([(c, Decimal(str(points[c] or 0))) for c in CRITERIA])
+    values = {'review_count': F('review_count') + sign}
+    for c in CRITERIA:
+        values['%s_sum' % c] = F('%s_sum' % c) + sign * points[c]
+    with commit_on_success_unless_managed():
+        if not Hotel.objects.filter(pk=hotel_id, review_count__isnull=False).update(**values):
+            reconcile_ratings([hotel_id])
+            return False
+        for c in CRITERIA:
+            _change_histogram(hotel_id, c, histogram_point(points[c]), sign)
+        refresh_hotel_points(hotel_id)
+    return True
+
+def reconcile_ratings(hotels_id=None):
+    """
+    Recalculate sums, counts, averages and histograms from all reviews.
+    Returns count of hotels.
+    """
+    hotels = Hotel.objects.all()
+    reviews = Review.objects.filter(hotel__isnull=False).order_by()
+    if hotels_id is not None:
+        hotels = hotels.filter(pk__in=hotels_id)
+        reviews = reviews.filter(hotel__in=hotels_id)
+    hotels_id = list(hotels.values_list('pk', flat=True))
+    sums = dict()
+    for row in reviews.values('hotel').annotate(review_count=Count('pk'),
+            **dict([('%s_sum' % c, Sum(c)) for c in CRITERIA])):
+        sums[row.pop('hotel')] = row
+    histogram = dict()
+    for c in CRITERIA:
+        for hotel_id, value, count in reviews.values_list('hotel', c).annotate(count=Count('pk')):
+            key = (hotel_id, c, histogram_point(value or 0))
+            histogram[key] = histogram.get(key, 0) + count
+    empty = dict([('%s_sum' % c, 0) for c in CRITERIA])
+    empty['review_count'] = 0
+    with commit_on_success_unless_managed():
+        for hotel_id in hotels_id:
+            values = sums.get(hotel_id, empty)
+            Hotel.objects.filter(pk=hotel_id).update(**dict([(k, v or 0) for k, v in values.items()]))
+            refresh_hotel_points(hotel_id)
+        for i in range(0, len(hotels_id), 500):
+            ReviewHistogram.objects.filter(hotel__in=hotels_id[i:i + 500]).delete()
+        ReviewHistogram.objects.bulk_create([ReviewHistogram(hotel_id=hotel_id, criterion=c, point=point, count=count)
+                                             for (hotel_id, c, point), count in histogram.items()])
+    return len(hotels_id)
+
+def hotel_histogram(hotel):
+    """
+    Returns {criterion: [(point, count), ...]} sorted by point
+    """
+    result = dict([(c, []) for c in CRITERIA])
+    for criterion, point, count in ReviewHistogram.objects.filter(hotel=hotel, count__gt=0).order_by(
+            'point').values_list('criterion', 'point', 'count'):
+        result[criterion].append((point, count))
+    return result
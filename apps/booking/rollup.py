@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Daily occupancy and revenue of hotels in HotelDayStat. Booking adds to
+every night of stay one sold room-night, equal part of amount and of
+commission while it has sold status. Remaining is sum of placecount of
+rooms of hotel.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+from nnmware.apps.booking.models import Booking, Availability, HotelDayStat, STATUS_ACCEPTED, \
+    STATUS_PRE_CONFIRMED, STATUS_CONFIRMED, STATUS_PAID, STATUS_COMPLETED
+from nnmware.apps.booking.availability import as_date, QUERY_CHUNK
+from nnmware.core.financial import iterate_values
+from nnmware.core.utils import commit_on_success_unless_managed
+
+SOLD_STATUSES = (STATUS_ACCEPTED, STATUS_PRE_CONFIRMED, STATUS_CONFIRMED, STATUS_PAID, STATUS_COMPLETED)
+
+
+def split_nights(from_date, to_date, amount, commission):
+    """
+    Returns [(date, amount, commission), ...] for every night, amounts
+    split equally and rest of rounding is on last night
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    nights = (to_date - from_date).days
+    if nights < 1:
+        return []
+    amount, commission = Decimal(str(amount or 0)), Decimal(str(commission or 0))
+    night_amount = (amount / nights).quantize(Decimal('0.001'))
+    night_commission = (commission / nights).quantize(Decimal('0.001'))
+    result = [(from_date + timedelta(days=i), night_amount, night_commission) for i in range(nights - 1)]
+    result.append((to_date - timedelta(days=1), amount - night_amount * (nights - 1),
+                   commission - night_commission * (nights - 1)))
+    return result
+
+def _add_day(hotel_id, on_date, sold, revenue, commission):
+    day = HotelDayStat.objects.filter(hotel=hotel_id, date=on_date)
+    values = {'sold': F('sold') + sold, 'revenue': F('revenue') + revenue, 'commission': F('commission') + commission}
+    if day.update(**values):
+        return
+    try:
+        sid = transaction.savepoint()
+        HotelDayStat(hotel_id=hotel_id, date=on_date, sold=sold, revenue=revenue, commission=commission).save()
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Created by concurrent booking
+        transaction.savepoint_rollback(sid)
+        day.update(**values)
+
+def _stat_nights(values):
+    if values is None:
+        return None, []
+    hotel_id, status, from_date, to_date, amount, commission = values
+    if hotel_id is None or status not in SOLD_STATUSES or from_date is None or to_date is None:
+        return hotel_id, []
+    return hotel_id, split_nights(from_date, to_date, amount, commission)
+
+def change_booking_stat(old, new):
+    """
+    old and new are Booking.stat_values() before and after change, None
+    for booking which not exists
+    """
+    old_hotel, old_nights = _stat_nights(old)
+    new_hotel, new_nights = _stat_nights(new)
+    with commit_on_success_unless_managed():
+        for on_date, amount, commission in old_nights:
+            _add_day(old_hotel, on_date, -1, -amount, -commission)
+        for on_date, amount, commission in new_nights:
+            _add_day(new_hotel, on_date, 1, amount, commission)
+        if old_nights:
+            refresh_remaining(dates=[n[0] for n in old_nights], pk=old_hotel)
+        if new_nights:
+            refresh_remaining(dates=[n[0] for n in new_nights], pk=new_hotel)
+
+def refresh_remaining(dates, **filters):
+    """
+    Recalculate remaining places on dates for hotels selected by filters
+    for Hotel, e.g. pk=hotel_id or room__id=room_id
+    """
+    from nnmware.apps.booking.models import Hotel
+    dates = [as_date(d) for d in dates]
+    if not dates:
+        return
+    hotels_id = list(Hotel.objects.filter(**filters).values_list('pk', flat=True))
+    if not hotels_id:
+        return
+    remaining = dict()
+    for hotel_id, on_date, placecount in Availability.objects.filter(room__hotel__in=hotels_id,
+            date__in=dates).order_by().values_list('room__hotel', 'date').annotate(Sum('placecount')):
+        remaining[(hotel_id, on_date)] = placecount or 0
+    existing = set(HotelDayStat.objects.filter(hotel__in=hotels_id, date__in=dates).values_list('hotel', 'date'))
+    created = []
+    by_value = dict()
+    for hotel_id in hotels_id:
+        for on_date in dates:
+            value = remaining.get((hotel_id, on_date), 0)
+            if (hotel_id, on_date) in existing:
+                by_value.setdefault((hotel_id, value), []).append(on_date)
+            elif value:
+                created.append(HotelDayStat(hotel_id=hotel_id, date=on_date, remaining=value))
+    # Days with same remaining updated by one query
+    for (hotel_id, value), days in by_value.items():
+        for i in range(0, len(days), QUERY_CHUNK):
+            HotelDayStat.objects.filter(hotel=hotel_id, date__in=days[i:i + QUERY_CHUNK]).update(remaining=value)
+    if created:
+        try:
+            sid = transaction.savepoint()
+            HotelDayStat.objects.bulk_create(created)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            for day in created:
+                HotelDayStat.objects.filter(hotel=day.hotel_id, date=day.date).update(remaining=day.remaining)
+
+def backfill_day_stats(from_date, to_date, hotels_id=None):
+    """
+    Rebuild HotelDayStat in [from_date, to_date] from bookings and
+    availability. Returns count of rows.
+    """
+    from_date, to_date = as_date(from_date), as_date(to_date)
+    bookings = Booking.objects.filter(status__in=SOLD_STATUSES, hotel__isnull=False,
+        from_date__lte=to_date, to_date__gt=from_date)
+    availability = Availability.objects.filter(date__gte=from_date, date__lte=to_date, room__hotel__isnull=False)
+    days = HotelDayStat.objects.filter(date__gte=from_date, date__lte=to_date)
+    if hotels_id is not None:
+        bookings = bookings.filter(hotel__in=hotels_id)
+        availability = availability.filter(room__hotel__in=hotels_id)
+        days = days.filter(hotel__in=hotels_id)
+    stats = dict()
+    for hotel_id, b_from, b_to, amount, commission in iterate_values(bookings,
+            ('hotel', 'from_date', 'to_date', 'amount', 'commission')):
+        for on_date, night_amount, night_commission in split_nights(b_from, b_to, amount, commission):
+            if from_date <= on_date <= to_date:
+                day = stats.setdefault((hotel_id, on_date), [0, 0, Decimal(0), Decimal(0)])
+                day[0] += 1
+                day[2] += night_amount
+                day[3] += night_commission
+    for hotel_id, on_date, placecount in availability.order_by().values_list('room__hotel',
+            'date').annotate(Sum('placecount')):
+        stats.setdefault((hotel_id, on_date), [0, 0, Decimal(0), Decimal(0)])[1] = placecount or 0
+    with transaction.commit_on_success():
+        days.delete()
+        created = [HotelDayStat(hotel_id=hotel_id, date=on_date, sold=v[0], remaining=v[1], revenue=v[2],
+                                commission=v[3]) for (hotel_id, on_date), v in stats.items()]
+        for i in range(0, len(created), 500):
+            HotelDayStat.objects.bulk_create(created[i:i + 500])
+    return len(stats)
+
+def hotels_period_stats(from_date, to_date):
+    """
+    Sums of HotelDayStat per hotel in [from_date, to_date], grouped in database
+    """
+    return HotelDayStat.objects.filter(date__gte=from_date, date__lte=to_date).values(
+        'hotel', 'hotel__name', 'hotel__city__name').annotate(sold=Sum('sold'), remaining=Sum('remaining'),
+        revenue=Sum('revenue'), commission=Sum('commission'))
+
+def with_rates(row):
+    """
+    Add occupancy in percents and ADR to sums of hotel
+    """
+    sold, remaining = row['sold'] or 0, row['remaining'] or 0
+    if sold + remaining:
+        row['occupancy'] = Decimal(sold * 100) / (sold + remaining)
+    else:
+        row['occupancy'] = 0
+    if sold:
+        row['adr'] = Decimal(str(row['revenue'] or 0)) / sold
+    else:
+        row['adr'] = 0
+    return row
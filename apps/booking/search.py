@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of hotel search results keyed on normalized search parameters.
+
+Every city has version in shared cache, writes of availability, prices
+and hotels of city bump it. Result stored with version it was built on,
+stale result served to other requests while one request rebuild it.
+"""
+import time
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import cache
+from nnmware.apps.booking.models import Hotel
+
+SEARCH_TIMEOUT = getattr(settings, 'BOOKING_SEARCH_TIMEOUT', 60 * 60)
+SEARCH_STALE_WHILE_REVALIDATE = getattr(settings, 'BOOKING_SEARCH_STALE_WHILE_REVALIDATE', True)
+SEARCH_LOCK_TIMEOUT = getattr(settings, 'BOOKING_SEARCH_LOCK_TIMEOUT', 30)
+SEARCH_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+SEARCH_VERSION_KEY = 'nnmware_search_version_%s'
+SEARCH_KEY = 'nnmware_search_%s'
+
+
+def search_version(city_id):
+    """
+    Version of search results in city, None is for search in all cities
+    """
+    key = SEARCH_VERSION_KEY % city_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time()), SEARCH_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def bump_search_version(cities_id):
+    # Search in all cities depends on every city
+    for city_id in set(cities_id) | set([None]):
+        key = SEARCH_VERSION_KEY % city_id
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time()), SEARCH_VERSION_TIMEOUT)
+
+def cached_search(city_id, params, compute):
+    """
+    Returns result of compute() for search params in city. Result built
+    on older version returned as is if other request already rebuild it.
+    """
+    key = SEARCH_KEY % md5(repr((city_id,) + tuple(params))).hexdigest()
+    lock_key = key + '_lock'
+    version = search_version(city_id)
+    entry = cache.get(key)
+    if entry is not None:
+        if entry['version'] == version:
+            return entry['value']
+        if SEARCH_STALE_WHILE_REVALIDATE and not cache.add(lock_key, 1, SEARCH_LOCK_TIMEOUT):
+            return entry['value']
+    try:
+        value = compute()
+        cache.set(key, {'version': version, 'value': value}, SEARCH_TIMEOUT)
+    finally:
+        if entry is not None and SEARCH_STALE_WHILE_REVALIDATE:
+            cache.delete(lock_key)
+    return value
+
+
+class HotelIdList(object):
+    """
+    Ordered id hotels for paginator, hotels loaded only for requested slice
+    """
+    model = Hotel
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            ids = self.ids[k]
+            hotels = Hotel.objects.in_bulk(ids)
+            return [hotels[pk] for pk in ids if pk in hotels]
+        return Hotel.objects.get(pk=self.ids[k])
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils.unittest import skipIf, skipUnless
+from nnmware.apps.address.models import City, Tourism, TourismCategory
+from nnmware.apps.booking.models import Hotel, Room, SettlementVariant, PlacePrice, Availability, Booking, \
+    BookingSequence, BookingHold, PaymentMethod, Review
+from nnmware.apps.booking.allocator import permute, SystemIdAllocator, SYSTEM_ID_COUNT, SYSTEM_ID_MIN
+from nnmware.apps.booking.prices import price_matrix
+from nnmware.apps.booking import availability, inventory
+from nnmware.apps.booking.availability import reserve_room, free_rooms, NotEnoughPlaces
+from nnmware.apps.booking.inventory import InventoryIndex, inventory_update, inventory_after_commit
+from nnmware.apps.booking.ari import room_ari_grid, room_ari_update
+from nnmware.apps.booking.ari_import import ari_rows
+from nnmware.apps.booking.holds import release_holds, release_expired_holds
+from nnmware.apps.booking.rating import reconcile_ratings
+from nnmware.core.utils import commit_on_success_unless_managed
+
+
+def make_hotel(name='Hotel', rooms=1, settlements=(1, 2)):
+    """
+    Hotel with rooms and enabled settlements, returns (hotel, [room, ...])
+    """
+    city, created = City.objects.get_or_create(name='Test city', defaults={'latitude': 59.9, 'longitude': 30.3})
+    hotel = Hotel.objects.create(name=name, city=city, latitude=59.9, longitude=30.3)
+    result = []
+    for i in range(rooms):
+        room = Room.objects.create(name='Room %s' % i, hotel=hotel)
+        SettlementVariant.objects.bulk_create([SettlementVariant(room=room, settlement=s) for s in settlements])
+        result.append(room)
+    return hotel, result
+
+def make_availability(room, from_date, placecounts):
+    Availability.objects.bulk_create([Availability(room=room, date=from_date + timedelta(days=i), placecount=p)
+                                      for i, p in enumerate(placecounts)])
+
+
+class PriceMatrixTest(TestCase):
+
+    def setUp(self):
+        self.hotel, self.rooms = make_hotel(rooms=3)
+        self.settlements = list(SettlementVariant.objects.filter(room__hotel=self.hotel))
+        self.from_date = date(2013, 1, 1)
+        prices = []
+        for i, s in enumerate(self.settlements):
+            # Prices change every 10 days, first one before range
+            for day in range(-5, 365, 10):
+                prices.append(PlacePrice(settlement=s, date=self.from_date + timedelta(days=day + i),
+                    amount=Decimal(1000 + day + i)))
+        PlacePrice.objects.bulk_create(prices)
+
+    def test_same_as_amount_on_date(self):
+        to_date = self.from_date + timedelta(days=40)
+        matrix = price_matrix(self.settlements, self.from_date, to_date)
+        for s in self.settlements:
+            for on_date in matrix.dates:
+                self.assertEqual(matrix.price(s, on_date), s.amount_on_date(on_date))
+
+    def test_no_price_before_first(self):
+        matrix = price_matrix(self.settlements, self.from_date - timedelta(days=30), self.from_date)
+        self.assertEqual(matrix.row(self.settlements[-1])[0], 0)
+
+    def test_one_query(self):
+        with self.assertNumQueries(1):
+            price_matrix(self.settlements, self.from_date, self.from_date + timedelta(days=365))
+        with self.assertNumQueries(1):
+            price_matrix(self.settlements[:1], self.from_date, self.from_date + timedelta(days=1))
+
+    def test_hotel_amount_on_date_queries(self):
+        with self.assertNumQueries(3):
+            self.hotel.amount_on_date(self.from_date + timedelta(days=100))
+        other, rooms = make_hotel('Other', rooms=10)
+        with self.assertNumQueries(3):
+            other.amount_on_date(self.from_date)
+
+
+
+class RoomAriGridTest(TestCase):
+
+    def setUp(self):
+        self.hotel, rooms = make_hotel(settlements=(1, 2, 3))
+        self.room = rooms[0]
+        self.settlements = list(SettlementVariant.objects.filter(room=self.room).order_by('settlement'))
+        self.from_date = date(2013, 1, 1)
+        self.dates = [self.from_date + timedelta(days=i) for i in range(365)]
+        prices = dict([(s.pk, dict([(d, 1000 * s.settlement + i) for i, d in enumerate(self.dates) if i % 3]))
+                       for s in self.settlements])
+        room_ari_update(self.room, dict([(d, i % 5) for i, d in enumerate(self.dates)]),
+            dict([(d, 10) for d in self.dates[::7]]), prices)
+
+    def test_queries_do_not_depend_on_dates(self):
+        # Settlements and one range query for every table
+        with self.assertNumQueries(4):
+            room_ari_grid(self.room, self.dates)
+        with self.assertNumQueries(4):
+            room_ari_grid(self.room, self.dates[:7])
+
+    def test_values(self):
+        settlements, rows = room_ari_grid(self.room, self.dates)
+        self.assertEqual([s.pk for s in settlements], [s.pk for s in self.settlements])
+        self.assertEqual(len(rows), 365)
+        self.assertEqual(rows[0]['placecount'], 0)
+        self.assertEqual(rows[0]['discount'], 10)
+        self.assertEqual(rows[0]['prices'][0][1], '')
+        self.assertEqual(rows[1]['discount'], '')
+        self.assertEqual(rows[1]['placecount'], 1)
+        self.assertEqual([amount for s, amount in rows[1]['prices']], [1001, 2001, 3001])
+
+
+class Pipe(object):
+    # Like piped stdin, no tell() and seek()
+
+    def __init__(self, data):
+        self.lines = data.splitlines(True)
+
+    def readline(self):
+        return self.lines.pop(0) if self.lines else ''
+
+
+class AriRowsTest(SimpleTestCase):
+    CSV = 'room,date,placecount\n1,2013-01-01,3\n\n2,2013-01-02,4\n'
+    JSONL = '{"room": 1}\n\n{"room": 2}\n'
+
+    def test_pipe(self):
+        rows = list(ari_rows(Pipe(self.CSV), 'csv'))
+        self.assertEqual([r['placecount'] for position, r in rows], ['3', '4'])
+        self.assertEqual([position for position, r in rows], [36, len(self.CSV)])
+        rows = list(ari_rows(Pipe(self.JSONL), 'jsonl'))
+        self.assertEqual(rows, [(12, {'room': 1}), (len(self.JSONL), {'room': 2})])
+
+    def test_resume_from_offset(self):
+        for data, file_format in ((self.CSV, 'csv'), (self.JSONL, 'jsonl')):
+            position, row = list(ari_rows(StringIO(data), file_format))[0]
+            self.assertEqual(list(ari_rows(StringIO(data), file_format, position)),
+                             list(ari_rows(StringIO(data), file_format))[1:])
+
+
+class InventoryIndexTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.idx')
+        os.close(fd)
+        self.index = InventoryIndex(self.path)
+        self.saved = inventory._index, inventory.INVENTORY_ENABLED, availability.INVENTORY_ENABLED
+        inventory._index = self.index
+        inventory.INVENTORY_ENABLED = availability.INVENTORY_ENABLED = True
+        self.hotel, rooms = make_hotel(settlements=(1, 2))
+        self.room = rooms[0]
+        self.from_date = date.today() + timedelta(days=10)
+        self.to_date = self.from_date + timedelta(days=3)
+        make_availability(self.room, self.from_date, [2, 2, 2])
+        self.index.update(self.room.pk, dict([(self.from_date + timedelta(days=i), 2) for i in range(3)]), 2)
+
+    def tearDown(self):
+        inventory._index, inventory.INVENTORY_ENABLED, availability.INVENTORY_ENABLED = self.saved
+        self.index.mm.close()
+        os.close(self.index.fd)
+        os.remove(self.path)
+
+    def free(self, roomcount, to_date=None):
+        return self.index.free_rooms([self.room.pk], self.from_date, to_date or self.to_date, roomcount)
+
+    def test_write_then_read(self):
+        self.assertEqual(self.free(4), ([self.room.pk], []))
+        self.assertEqual(self.free(5), ([], []))
+        self.index.update(self.room.pk, {self.from_date + timedelta(days=1): 0})
+        self.assertEqual(self.free(1), ([], []))
+        # Day which was never written is asked from database
+        self.assertEqual(self.free(1, self.to_date + timedelta(days=1)), ([], [self.room.pk]))
+
+    def test_changed_row_falls_back_to_database(self):
+        offset = self.index._offset(self.room.pk)
+        generation = struct.unpack_from('=I', self.index.mm, offset)[0]
+        # Odd generation is row in the middle of write
+        struct.pack_into('=I', self.index.mm, offset, generation + 1)
+        self.assertEqual(self.free(1), ([], [self.room.pk]))
+        self.assertEqual(free_rooms([self.hotel], self.from_date, self.to_date, 4), {self.hotel.pk: [self.room.pk]})
+        self.assertEqual(free_rooms([self.hotel], self.from_date, self.to_date, 5), {})
+
+    def test_changes_dropped_when_block_raise(self):
+        try:
+            with inventory_after_commit():
+                inventory_update(self.room.pk, {self.from_date: 0})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.free(4), ([self.room.pk], []))
+        with inventory_after_commit():
+            Availability.objects.filter(room=self.room, date=self.from_date).update(placecount=0)
+            inventory_update(self.room.pk, {self.from_date: 0})
+            # Published after block
+            self.assertEqual(self.free(4), ([self.room.pk], []))
+        self.assertEqual(self.free(1), ([], []))
+
+    def test_verify(self):
+        self.assertEqual(self.index.rebuild([self.room.pk]), 1)
+        self.assertEqual(self.index.verify([self.room.pk]), [])
+        Availability.objects.filter(room=self.room, date=self.from_date).update(placecount=1)
+        self.assertEqual(self.index.verify([self.room.pk]), [(self.room.pk, self.from_date, 2, 1)])
+        self.index.rebuild([self.room.pk])
+        self.assertEqual(self.index.verify([self.room.pk]), [])
+
+
+class ReserveRoomTest(TestCase):
+
+    def setUp(self):
+        self.hotel, rooms = make_hotel()
+        self.room = rooms[0]
+        self.from_date = date.today() + timedelta(days=10)
+        make_availability(self.room, self.from_date, [2, 2, 2, 0])
+
+    def placecounts(self):
+        return list(Availability.objects.filter(room=self.room).order_by('date').values_list('placecount', flat=True))
+
+    def test_reserve(self):
+        result = reserve_room(self.room, self.from_date, self.from_date + timedelta(days=3))
+        self.assertEqual(sorted(result.values()), [1, 1, 1])
+        self.assertEqual(self.placecounts(), [1, 1, 1, 0])
+
+    @skipUnlessDBFeature('uses_savepoints')
+    def test_shortfall_rolled_back(self):
+        self.assertRaises(NotEnoughPlaces, reserve_room, self.room, self.from_date,
+            self.from_date + timedelta(days=4))
+        self.assertEqual(self.placecounts(), [2, 2, 2, 0])
+        self.assertRaises(NotEnoughPlaces, reserve_room, self.room, self.from_date,
+            self.from_date + timedelta(days=2), 3)
+        self.assertEqual(self.placecounts(), [2, 2, 2, 0])
+
+
+class ReleaseHoldsTest(TestCase):
+
+    def setUp(self):
+        self.hotel, rooms = make_hotel()
+        self.room = rooms[0]
+        self.from_date = date.today() + timedelta(days=10)
+        make_availability(self.room, self.from_date, [1, 1, 1])
+        BookingHold.objects.create(session_key='session', room=self.room,
+            settlement=SettlementVariant.objects.filter(room=self.room)[0], from_date=self.from_date,
+            to_date=self.from_date + timedelta(days=2), expire_date=datetime.now() - timedelta(minutes=1))
+
+    def placecounts(self):
+        return list(Availability.objects.filter(room=self.room).order_by('date').values_list('placecount', flat=True))
+
+    def test_release(self):
+        self.assertEqual(release_holds(BookingHold.objects.filter(session_key='session')), 1)
+        self.assertEqual(self.placecounts(), [2, 2, 1])
+        self.assertEqual(BookingHold.objects.count(), 0)
+        self.assertEqual(release_holds(BookingHold.objects.filter(session_key='session')), 0)
+
+    def test_release_expired(self):
+        self.assertEqual(release_expired_holds(), 1)
+        self.assertEqual(self.placecounts(), [2, 2, 1])
+
+    @skipUnlessDBFeature('uses_savepoints')
+    def test_rolled_back_with_caller(self):
+        try:
+            with commit_on_success_unless_managed():
+                release_holds(BookingHold.objects.filter(session_key='session'))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.placecounts(), [1, 1, 1])
+        self.assertEqual(BookingHold.objects.count(), 1)
+
+
+def _reserve_worker(room_id, from_date, to_date, attempts, queue):
+    # Child must not use connection of parent
+    connection.close()
+    sold = 0
+    for i in range(attempts):
+        try:
+            reserve_room(room_id, from_date, to_date)
+            sold += 1
+        except NotEnoughPlaces:
+            pass
+    connection.close()
+    queue.put(sold)
+
+
+class ReserveRoomConcurrencyTest(TransactionTestCase):
+    PROCESSES = 8
+    ATTEMPTS = 5
+    PLACES = 5
+
+    @skipIf(connection.vendor == 'sqlite', 'Processes need shared database server')
+    def test_no_overselling(self):
+        hotel, rooms = make_hotel()
+        room = rooms[0]
+        from_date = date.today() + timedelta(days=10)
+        to_date = from_date + timedelta(days=3)
+        make_availability(room, from_date, [self.PLACES] * 3)
+        connection.close()
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_reserve_worker,
+            args=(room.pk, from_date, to_date, self.ATTEMPTS, queue)) for i in range(self.PROCESSES)]
+        for worker in workers:
+            worker.start()
+        sold = sum([queue.get(timeout=60) for worker in workers])
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sold, self.PLACES)
+        self.assertEqual(list(Availability.objects.filter(room=room).values_list('placecount', flat=True)),
+                         [0, 0, 0])
+
+
+class RatingTest(TestCase):
+
+    def setUp(self):
+        self.hotel, rooms = make_hotel()
+        self.user = get_user_model().objects.create(username='reviewer')
+        # Reviews written before sums, without signals
+        Review.objects.bulk_create([Review(user=self.user, hotel=self.hotel, food=p, service=p, purity=p,
+            transport=p, prices=p) for p in (Decimal(8), Decimal(10))])
+
+    def hotel_points(self):
+        return Hotel.objects.filter(pk=self.hotel.pk).values('review_count', 'food', 'point')[0]
+
+    def test_first_change_counts_old_reviews(self):
+        self.assertEqual(self.hotel_points()['review_count'], None)
+        review = Review.objects.create(user=self.user, hotel=self.hotel, food=6, service=6, purity=6,
+            transport=6, prices=6)
+        self.assertEqual(self.hotel_points(), {'review_count': 3, 'food': Decimal(8), 'point': Decimal(8)})
+        review.food = 9
+        review.save()
+        review.delete()
+        points = self.hotel_points()
+        reconcile_ratings([self.hotel.pk])
+        self.assertEqual(points, self.hotel_points())
+        self.assertEqual(points['review_count'], 2)
+
+    def test_edit_of_old_review(self):
+        review = Review.objects.filter(hotel=self.hotel)[0]
+        review.food = Decimal(4)
+        review.save()
+        points = self.hotel_points()
+        reconcile_ratings([self.hotel.pk])
+        self.assertEqual(points, self.hotel_points())
+        self.assertEqual(points['review_count'], 2)
+
+
+class TourismPlacesTest(TestCase):
+
+    def setUp(self):
+        self.hotel, rooms = make_hotel()
+        category = TourismCategory.objects.create(name='Museum')
+        for name, latitude in (('Far', 59.95), ('Near', 59.901), ('Out of radius', 61.0)):
+            Tourism.objects.create(name=name, category=category, city=self.hotel.city, latitude=latitude,
+                longitude=30.3)
+
+    def test_nearest_first(self):
+        places = Hotel.objects.get(pk=self.hotel.pk).tourism_places()
+        self.assertEqual([t.name for t in places], ['Near', 'Far'])
+        self.assertAlmostEqual(places[0].distance, 0.111, places=2)
+        self.assertAlmostEqual(places[1].distance, 5.56, places=1)
+
+    def test_hotel_without_places_is_not_refreshed_again(self):
+        Hotel.objects.filter(pk=self.hotel.pk).update(tourism_updated_date=None, latitude=10, longitude=10)
+        self.assertEqual(Hotel.objects.get(pk=self.hotel.pk).tourism_places(), [])
+        hotel = Hotel.objects.get(pk=self.hotel.pk)
+        self.assertTrue(hotel.tourism_updated_date is not None)
+        with self.assertNumQueries(1):
+            self.assertEqual(hotel.tourism_places(), [])
+
+
+BENCHMARK_BOOKINGS = int(os.environ.get('NNMWARE_BENCHMARK_BOOKINGS', 0))
+
+
+class SystemIdTest(TestCase):
+
+    def test_permute_is_bijection(self):
+        values = set()
+        for n in xrange(200000):
+            value = permute(n)
+            self.assertTrue(0 <= value < SYSTEM_ID_COUNT)
+            values.add(value)
+        self.assertEqual(len(values), 200000)
+        self.assertTrue(0 <= permute(SYSTEM_ID_COUNT - 1) < SYSTEM_ID_COUNT)
+        self.assertRaises(ValueError, permute, SYSTEM_ID_COUNT)
+
+    def counter_value(self):
+        # Block can be reserved by other connection and left after test
+        values = list(BookingSequence.objects.filter(pk=1).values_list('value', flat=True))
+        return values[0] if values else 0
+
+    def test_counter_reserved_in_blocks(self):
+        allocator = SystemIdAllocator(block=100)
+        before = self.counter_value()
+        ids = [allocator.allocate() for i in range(1000)]
+        self.assertEqual(len(set(ids)), 1000)
+        self.assertTrue(min(ids) >= SYSTEM_ID_MIN)
+        # One reservation for every block, not a query for every id
+        self.assertEqual(self.counter_value() - before, 1000)
+
+    @skipUnlessDBFeature('uses_savepoints')
+    def test_block_kept_after_rollback(self):
+        allocator = SystemIdAllocator(block=10)
+        sid = transaction.savepoint()
+        allocator.allocate()
+        transaction.savepoint_rollback(sid)
+        other = SystemIdAllocator(block=10)
+        self.assertNotEqual(other.counter(), allocator.counter())
+
+    def test_allocators_do_not_collide(self):
+        first, second = SystemIdAllocator(block=10), SystemIdAllocator(block=10)
+        ids = []
+        for i in range(50):
+            ids.extend([first.allocate(), second.allocate()])
+        self.assertEqual(len(set(ids)), 100)
+
+
+def old_system_id():
+    # Booking.save before allocator
+    new_id = random.randint(100000000, 999999999)
+    while Booking.objects.filter(system_id=new_id).count() > 0:
+        new_id = random.randint(100000000, 999999999)
+    return new_id
+
+
+class SystemIdBenchmark(TransactionTestCase):
+    """
+    Run with NNMWARE_BENCHMARK_BOOKINGS=1000000 to compare with old loop
+    """
+    ALLOCATIONS = 200
+
+    @skipUnless(BENCHMARK_BOOKINGS, 'Set NNMWARE_BENCHMARK_BOOKINGS to run benchmark')
+    def test_allocator_against_random_loop(self):
+        payment_method = PaymentMethod.objects.create(name='Cash')
+        today = date.today()
+        # system_id is unique, old random ids without repeats
+        system_ids = random.sample(xrange(100000000, 1000000000), BENCHMARK_BOOKINGS)
+        for i in range(0, BENCHMARK_BOOKINGS, 10000):
+            Booking.objects.bulk_create([Booking(system_id=system_id, from_date=today, to_date=today,
+                first_name='A', last_name='B', payment_method=payment_method)
+                for system_id in system_ids[i:i + 10000]])
+        started = time.time()
+        for i in range(self.ALLOCATIONS):
+            old_system_id()
+        old_time = time.time() - started
+        allocator = SystemIdAllocator()
+        started = time.time()
+        for i in range(self.ALLOCATIONS):
+            allocator.allocate()
+        new_time = time.time() - started
+        sys.stderr.write('\n%s ids with %s bookings: random loop %.3f s, allocator %.3f s\n' % (
+            self.ALLOCATIONS, BENCHMARK_BOOKINGS, old_time, new_time))
+        self.assertTrue(new_time < old_time)
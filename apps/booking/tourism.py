@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed tourism places near hotels, tourism_updated_date of hotel is
+set when places of hotel are calculated
+"""
+from datetime import datetime
+from django.conf import settings
+from nnmware.apps.address.models import Tourism
+from nnmware.apps.address.proximity import near
+from nnmware.apps.booking.models import Hotel, HotelTourism
+from nnmware.core.utils import commit_on_success_unless_managed
+
+MILE = 1.609344
+# TOURISM_PLACES_RADIUS is in miles as in old places_near_object query
+TOURISM_RADIUS = getattr(settings, 'TOURISM_PLACES_RADIUS', 10) * MILE
+
+
+def _has_position(obj):
+    return obj.latitude or obj.longitude
+
+def refresh_hotel_tourism(hotel):
+    """
+    Recalculate tourism places near hotel, returns count of places
+    """
+    places = []
+    hotel.tourism_updated_date = datetime.now()
+    with commit_on_success_unless_managed():
+        HotelTourism.objects.filter(hotel=hotel).delete()
+        if _has_position(hotel):
+            places = near(Tourism.objects.all(), hotel.latitude, hotel.longitude, TOURISM_RADIUS)
+            HotelTourism.objects.bulk_create([HotelTourism(hotel_id=hotel.pk, tourism_id=pk, distance=d)
+                                              for pk, d in places])
+        Hotel.objects.filter(pk=hotel.pk).update(tourism_updated_date=hotel.tourism_updated_date)
+    return len(places)
+
+def refresh_tourism_hotels(tourism):
+    """
+    Recalculate hotels near tourism place, returns count of hotels
+    """
+    with commit_on_success_unless_managed():
+        HotelTourism.objects.filter(tourism=tourism).delete()
+        if not _has_position(tourism):
+            return 0
+        hotels = near(Hotel.objects.all(), tourism.latitude, tourism.longitude, TOURISM_RADIUS)
+        HotelTourism.objects.bulk_create([HotelTourism(hotel_id=pk, tourism_id=tourism.pk, distance=d)
+                                          for pk, d in hotels])
+    return len(hotels)
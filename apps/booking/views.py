@@ -4,6 +4,7 @@ from datetime import date, timedelta, datetime
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.mail import mail_managers
+from django.db import transaction
 from django.http import Http404, get_host, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
@@ -16,11 +17,20 @@ from django.utils.translation import ugettext_lazy as _
 from nnmware.apps.booking.models import *
 from nnmware.apps.booking.forms import *
 from nnmware.apps.booking.utils import guests_from_request, booking_new_hotel_mail, request_add_hotel_mail
+from nnmware.apps.booking.availability import free_hotels, reserve_room, NotEnoughPlaces
+from nnmware.apps.booking.inventory import inventory_update, inventory_after_commit
+from nnmware.apps.booking.ari import room_ari_grid
+from nnmware.apps.booking.prices import refresh_hotel_amounts
+from nnmware.apps.booking.facets import hotel_facets, facets_key
+from nnmware.apps.booking.search import cached_search, search_version, HotelIdList
+from nnmware.apps.booking.rating import hotel_histogram
+from nnmware.apps.booking.rollup import hotels_period_stats, with_rates
+from nnmware.apps.booking.holds import hold_room, take_hold, release_holds, booking_quote
 from nnmware.apps.userprofile.models import Profile
 from nnmware.core.ajax import AjaxLazyAnswer
 from nnmware.core.config import CURRENCY
 from nnmware.core.views import AttachedImagesMixin, AttachedFilesMixin, AjaxFormMixin, \
-    CurrentUserSuperuser, RedirectHttpView, RedirectHttpsView
+    CurrentUserSuperuser, RedirectHttpView, RedirectHttpsView, ExportMixin
 from nnmware.apps.money.models import Bill, Currency
 import time
 from nnmware.core.utils import date_range, convert_to_date, daterange
@@ -113,10 +123,10 @@ class HotelList(RedirectHttpView, ListView):
         t_date = self.request.GET.get('to') or None
         amount_min = self.request.GET.get('amount_min') or None
         amount_max = self.request.GET.get('amount_max') or None
-        if amount_min:
-            a_min = convert_from_client_currency(self.request, amount_min)
-        if amount_max:
-            a_max = convert_from_client_currency(self.request, amount_max)
+        amounts = None
+        if amount_max and amount_min:
+            amounts = (int(convert_from_client_currency(self.request, amount_min)),
+                       int(convert_from_client_currency(self.request, amount_max)))
         try:
             self.city = City.objects.get(slug=self.kwargs['slug'])
             hotels = Hotel.objects.filter(city=self.city)
@@ -126,9 +136,8 @@ class HotelList(RedirectHttpView, ListView):
         self.tab = {'css_name':'asc','css_class':'desc','css_amount':'desc','css_review':'desc',
                     'order_name':'desc','order_class':'desc','order_amount':'desc','order_review':'desc',
                     'tab':'name'}
-
+        from_date, to_date = None, None
         if (notknowndates and self.city ) or (f_date and t_date and self.city):
-            result = []
             try:
                 from_date = convert_to_date(f_date)
                 to_date = convert_to_date(t_date)
@@ -138,84 +147,100 @@ class HotelList(RedirectHttpView, ListView):
                 else:
                     self.search_data = {'from_date':f_date, 'to_date':t_date, 'guests':guests}
                 self.search_data['city'] = self.city
-                for hotel in hotels:
-                    if hotel.free_room(from_date,to_date,guests):
-                        result.append(hotel.pk)
-                search_hotel = Hotel.objects.filter(pk__in=result)
             except :
-                search_hotel = hotels
+                from_date, to_date = None, None
             self.search = 1
         else :
             self.search = 0
-            search_hotel = hotels
-        if amount_max and amount_min:
-            r = []
-            for h in search_hotel:
-                amount = h.min_current_amount
-                if int(a_min) < amount < int(a_max):
-                    r.append(h.pk)
-            search_hotel = Hotel.objects.filter(pk__in=r)
-        if options:
-            for option in options:
-                search_hotel = search_hotel.filter(option=option)
-        if stars:
-            search_hotel = search_hotel.filter(starcount__in=stars)
+        order_by = None
         if order:
             if order == 'name':
                 self.tab['tab'] = 'name'
                 if sort == 'desc':
-                    result = search_hotel.order_by('-name')
+                    order_by = '-name'
                     self.tab['css_name'] = 'desc'
                     self.tab['order_name'] = 'asc'
                 else:
-                    result = search_hotel.order_by('name')
+                    order_by = 'name'
                     self.tab['css_name'] = 'asc'
                     self.tab['order_name'] = 'desc'
             elif order == 'class':
                 self.tab['tab'] = 'class'
                 if sort == 'asc':
-                    result = search_hotel.order_by('starcount')
+                    order_by = 'starcount'
                     self.tab['css_class'] = 'asc'
                     self.tab['order_class'] = 'desc'
                 else:
-                    result = search_hotel.order_by('-starcount')
+                    order_by = '-starcount'
                     self.tab['css_class'] = 'desc'
                     self.tab['order_class'] = 'asc'
             elif order == 'amount':
                 self.tab['tab'] = 'amount'
                 if sort == 'asc':
-                    result = search_hotel.order_by('current_amount')
+                    order_by = 'current_amount'
                     self.tab['css_amount'] = 'asc'
                     self.tab['order_amount'] = 'desc'
                 else:
-                    result = search_hotel.order_by('-current_amount')
+                    order_by = '-current_amount'
                     self.tab['css_amount'] = 'desc'
                     self.tab['order_amount'] = 'asc'
             elif order == 'review':
                 self.tab['tab'] = 'review'
                 if sort == 'asc':
-                    result = search_hotel.order_by('point')
+                    order_by = 'point'
                     self.tab['css_review'] = 'asc'
                     self.tab['order_review'] = 'desc'
                 else:
-                    result = search_hotel.order_by('-point')
+                    order_by = '-point'
                     self.tab['css_review'] = 'desc'
                     self.tab['order_review'] = 'asc'
             else:
                 pass
+        if from_date is None:
+            params = (None, None, None)
         else:
-            result = search_hotel
-        try:
-            self.result_count = search_hotel.count()
-        except:
-            self.result_count = None
-        return result
+            params = (from_date, to_date, guests)
+        params += (tuple(sorted(options or [])), tuple(sorted(stars or [])), amounts, order_by)
+        result = cached_search(getattr(self.city, 'pk', None), params,
+            lambda: self.find_hotels(hotels, from_date, to_date, guests, amounts, options, stars, order_by))
+        self.result_count = result['count']
+        self.facets = result['facets']
+        return HotelIdList(result['ids'])
+
+    def find_hotels(self, hotels, from_date, to_date, guests, amounts, options, stars, order_by):
+        """
+        Returns {'ids': ordered list of id hotels, 'count': count, 'facets': facets}
+        """
+        search_hotel = hotels
+        if from_date is not None:
+            try:
+                result = free_hotels(hotels, from_date, to_date, guests)
+                search_hotel = Hotel.objects.filter(pk__in=result)
+            except :
+                from_date, to_date = None, None
+        version = search_version(getattr(self.city, 'pk', None))
+        facets = hotel_facets(search_hotel, facets_key(self.city, from_date, to_date, guests, version))
+        if amounts or order_by in ('current_amount', '-current_amount'):
+            # Price changed after last refresh_hotel_amount run
+            refresh_hotel_amounts(search_hotel.filter(amount_dirty=True).values_list('pk', flat=True))
+        if amounts:
+            search_hotel = search_hotel.filter(current_amount__gt=amounts[0], current_amount__lt=amounts[1])
+        if options:
+            for option in options:
+                search_hotel = search_hotel.filter(option=option)
+        if stars:
+            search_hotel = search_hotel.filter(starcount__in=stars)
+        if order_by:
+            search_hotel = search_hotel.order_by(order_by)
+        ids = list(search_hotel.values_list('pk', flat=True))
+        return {'ids': ids, 'count': len(ids), 'facets': facets}
 
     def get_context_data(self, **kwargs):
     # Call the base implementation first to get a context
         context = super(HotelList, self).get_context_data(**kwargs)
         context['title_line'] = _('list of hotels')
         context['tab'] = self.tab
+        context['facets'] = self.facets
         if self.search:
             context['search'] = self.search
             context['search_count'] = self.result_count
@@ -298,6 +323,7 @@ class HotelLocation(RedirectHttpView, HotelPathMixin, DetailView):
         context['city'] = self.object.city
         context['hotels_in_city'] = Hotel.objects.filter(city=self.object.city).count()
         context['tourism_list'] = self.object.tourism_places()
+        context['distances'] = dict([(t.pk, t.distance) for t in context['tourism_list']])
         context['title_line'] = self.object.get_name
         context['tab'] = 'location'
         return context
@@ -314,6 +340,7 @@ class HotelReviews(HotelPathMixin, SingleObjectMixin, ListView):
         context['city'] = self.object.city
         context['hotels_in_city'] = Hotel.objects.filter(city=self.object.city).count()
         context['tab'] = 'reviews'
+        context['rating_histogram'] = hotel_histogram(self.object)
         context['title_line'] = self.object.get_name
         return context
 
@@ -445,6 +472,7 @@ class CabinetEditRoom(CurrentUserRoomAdmin, AttachedImagesMixin, UpdateView):
                 settlement.save()
             except :
                 SettlementVariant(room=self.object,settlement=variant, enabled=True).save()
+        inventory_update(self.object.pk, places=max([int(v) for v in variants]))
         return super(CabinetEditRoom, self).form_valid(form)
 
 
@@ -489,6 +517,8 @@ class CabinetRates(HotelPathMixin, CurrentUserHotelAdmin, DetailView):
                 date_period.append(i)
         context['dates'] = date_period
         context['days_of_week'] = days_of_week
+        if 'room_id' in context:
+            context['settlements'], context['grid'] = room_ari_grid(context['room_id'], date_period)
         return context
 
 class CabinetDiscount(CabinetRates):
@@ -516,10 +546,15 @@ class CabinetBillEdit(CurrentUserHotelBillAccess, AttachedFilesMixin, UpdateView
     def get_success_url(self):
         return reverse('cabinet_bills', args=[self.object.target.city.slug,self.object.target.slug])
 
-class CabinetBookings(HotelPathMixin, CurrentUserHotelAdmin, SingleObjectMixin, ListView):
+BOOKING_EXPORT_FIELDS = ('system_id', 'date', 'hotel__name', 'from_date', 'to_date', 'status', 'last_name',
+    'first_name', 'middle_name', 'phone', 'email', 'amount', 'currency__code', 'commission', 'hotel_sum')
+
+class CabinetBookings(HotelPathMixin, CurrentUserHotelAdmin, SingleObjectMixin, ExportMixin, ListView):
 #    model = Hotel
     paginate_by = 20
     template_name = "cabinet/bookings.html"
+    export_fields = BOOKING_EXPORT_FIELDS
+    export_name = 'bookings'
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -593,10 +628,12 @@ class RequestAddHotelView(CreateView):
         return super(RequestAddHotelView, self).form_valid(form)
 
 
-class BookingsList(CurrentUserSuperuser, ListView):
+class BookingsList(CurrentUserSuperuser, ExportMixin, ListView):
     model = Booking
     paginate_by = 20
     template_name = "sysadm/bookings.html"
+    export_fields = BOOKING_EXPORT_FIELDS
+    export_name = 'bookings'
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -629,6 +666,17 @@ class RequestsList(CurrentUserSuperuser, ListView):
         context['title_line'] = _('request for add')
         return context
 
+REPORT_TYPES = (
+    ('all', _('All hotels in system')),
+    ('notsetpayment', _('Hotels without payment methods')),
+    ('setpayment', _('Hotels with payment methods')),
+    ('notsetadmins', _('Hotels without admins')),
+    ('setadmins', _('Hotels with admins')),
+    ('occupancy', _('Occupancy of hotels')),
+    ('revenue', _('Revenue of hotels')),
+)
+ROLLUP_REPORTS = ('occupancy', 'revenue')
+
 class ReportsList(CurrentUserSuperuser, TemplateView):
     template_name = "sysadm/reports.html"
 
@@ -637,17 +685,21 @@ class ReportsList(CurrentUserSuperuser, TemplateView):
         context = super(ReportsList, self).get_context_data(**kwargs)
         context['tab'] = 'reports'
         context['title_line'] = _('site reports')
+        context['reports'] = REPORT_TYPES
         return context
 
-class ReportView(CurrentUserSuperuser, ListView):
+class ReportView(CurrentUserSuperuser, ExportMixin, ListView):
     paginate_by = 50
     model = Hotel
     template_name = "sysadm/report.html"
+    export_fields = ('name', 'city__name', 'starcount', 'address', 'phone', 'email', 'contact_name',
+        'contact_email', 'register_date')
 
     def get_queryset(self):
         report_type = self.kwargs['slug'] or None
+        self.export_name = 'report_%s' % report_type
         self.report_name = _('Error')
-        result = []
+        result = Hotel.objects.none()
         if report_type == 'all':
             result = Hotel.objects.all()
             self.report_name = _('All hotels in system')
@@ -663,10 +715,43 @@ class ReportView(CurrentUserSuperuser, ListView):
         elif report_type == 'setadmins':
             result = Hotel.objects.exclude(admins=None)
             self.report_name = _('Hotels with admins')
-        if result:
-            result = result.order_by('city__name','name')
-        self.result_count = len(result)
         self.report_arg = report_type
+        if report_type in ROLLUP_REPORTS:
+            return self.get_rollup_queryset(report_type)
+        result = result.order_by('city__name','name')
+        self.result_count = result.count()
+        return result
+
+    def get_report_dates(self):
+        try:
+            from_date = convert_to_date(self.request.GET['from']).date()
+            to_date = convert_to_date(self.request.GET['to']).date()
+            if from_date > to_date:
+                from_date, to_date = to_date, from_date
+        except (KeyError, ValueError):
+            to_date = date.today()
+            from_date = date(to_date.year, 1, 1)
+        return from_date, to_date
+
+    def get_rollup_queryset(self, report_type):
+        self.from_date, self.to_date = self.get_report_dates()
+        result = hotels_period_stats(self.from_date, self.to_date)
+        if report_type == 'occupancy':
+            result = result.order_by('-sold', 'hotel__city__name', 'hotel__name')
+            self.report_name = _('Occupancy of hotels')
+        else:
+            result = result.order_by('-revenue', 'hotel__city__name', 'hotel__name')
+            self.report_name = _('Revenue of hotels')
+        self.result_count = result.count()
+        return result
+
+    def get_export_queryset(self):
+        result = self.get_queryset()
+        if self.report_arg in ROLLUP_REPORTS:
+            # Rows of days, grouped report is small enough to be shown
+            self.export_fields = ('hotel__name', 'hotel__city__name', 'date', 'sold', 'remaining', 'revenue',
+                'commission')
+            result = HotelDayStat.objects.filter(date__gte=self.from_date, date__lte=self.to_date)
         return result
 
     def get_context_data(self, **kwargs):
@@ -677,6 +762,9 @@ class ReportView(CurrentUserSuperuser, ListView):
         context['report_name'] = self.report_name
         context['result_count'] = self.result_count
         context['report_arg'] = self.report_arg
+        if self.report_arg in ROLLUP_REPORTS:
+            context['object_list'] = [with_rates(row) for row in context['object_list']]
+            context['from_date'], context['to_date'] = self.from_date, self.to_date
         return context
 
 
@@ -777,16 +865,16 @@ class ClientBooking(RedirectHttpsView, DetailView):
                 from_date,to_date = to_date,from_date
             if (from_date-datetime.now()).days < -1:
                 raise Http404
-            avail_count = Availability.objects.filter(room=room,
-                date__range=(from_date, to_date-timedelta(days=1)),placecount__gt=0).count()
-            if avail_count <> (to_date-from_date).days:
-                raise Http404
             settlement = SettlementVariant.objects.filter(room=room,
                 settlement__gte=guests, enabled=True).order_by('settlement')[0]
             #settlement = get_object_or_404(SettlementVariant,room=room,settlement=guests,enabled=True)
-            valid_price_count = PlacePrice.objects.filter(settlement=settlement,
-                date__range=(from_date, to_date-timedelta(days=1)),amount__gt=0).count()
-            if valid_price_count <> (to_date-from_date).days:
+            if not self.request.session.session_key:
+                self.request.session.save()
+            try:
+                hold = hold_room(self.request.session.session_key, room, settlement, from_date, to_date)
+            except NotEnoughPlaces:
+                raise Http404
+            if hold is None:
                 raise Http404
             context = super(ClientBooking, self).get_context_data(**kwargs)
             context['hotel_count'] = Hotel.objects.filter(city=self.object.city).count()
@@ -796,6 +884,7 @@ class ClientBooking(RedirectHttpsView, DetailView):
             context['room_id'] = room_id
             context['room'] = room
             context['settlements'] = s
+            context['hold'] = hold
             context['search_data'] = {'from_date':f_date, 'to_date':t_date, 'guests':guests}
             return context
         else :
@@ -848,21 +937,6 @@ class ClientAddBooking(AjaxFormMixin, CreateView):
         self.object.date = datetime.now()
         from_date = self.object.from_date
         to_date = self.object.to_date
-        all_amount = Decimal(0)
-        commission = Decimal(0)
-        on_date = from_date
-        while on_date < to_date:
-            price = PlacePrice.objects.get(settlement=settlement, date = on_date)
-            percent = self.object.hotel.get_percent_on_date(on_date)
-            commission += (price.amount*percent)/100
-            all_amount += price.amount
-            avail = Availability.objects.get(room=room, date = on_date)
-            avail.placecount -= 1
-            avail.save()
-            on_date = on_date+timedelta(days=1)
-        self.object.amount = all_amount
-        self.object.hotel_sum = all_amount - commission
-        self.object.commission = commission
         currency = Currency.objects.get(code=CURRENCY)
         self.object.currency = currency
         self.object.ip = self.request.META['REMOTE_ADDR']
@@ -872,7 +946,33 @@ class ClientAddBooking(AjaxFormMixin, CreateView):
             self.object.card_holder = card_holder
             self.object.card_valid = card_valid
             self.object.card_cvv2 = card_cvv2
-        self.object.save()
+        try:
+            # Reserve and insert of booking are committed or rolled back together,
+            # index is changed after commit
+            with inventory_after_commit():
+                with transaction.commit_on_success():
+                    # Places and amounts frozen by hold of booking form
+                    session_key = self.request.session.session_key
+                    hold = take_hold(session_key, room, settlement, from_date, to_date)
+                    if hold is not None:
+                        all_amount, commission = hold.amount, hold.commission
+                    else:
+                        quote = booking_quote(settlement, from_date, to_date)
+                        if quote is None:
+                            raise NotEnoughPlaces
+                        all_amount, commission = quote
+                        # Other or expired hold of session must not keep places
+                        if session_key:
+                            release_holds(BookingHold.objects.filter(session_key=session_key))
+                        placecounts = reserve_room(room, from_date, to_date)
+                        inventory_update(room.pk, placecounts)
+                    self.object.amount = all_amount
+                    self.object.hotel_sum = all_amount - commission
+                    self.object.commission = commission
+                    self.object.save()
+        except NotEnoughPlaces:
+            payload = {'success': False, 'engine_error':_('Sorry, room is not available on your dates.')}
+            return AjaxLazyAnswer(payload)
         self.success_url = self.object.get_client_url()
         if self.request.user.is_authenticated:
             booking_new_client_mail(self.object, self.request.user.username)
@@ -7,6 +7,7 @@ from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
+from django.db.models import signals
 from nnmware.apps.address.models import Country
 from nnmware.core.config import CURRENCY, OFFICIAL_RATE
 from nnmware.core.managers import FinancialManager
@@ -147,3 +148,10 @@ class Bill(MoneyBase):
     def docs(self):
         return Doc.objects.metalinks_for_object(self)
 
+
+def exchange_rate_changed(sender, instance, **kwargs):
+    from nnmware.apps.money.rates import bump_rates_version
+    bump_rates_version()
+
+signals.post_save.connect(exchange_rate_changed, sender=ExchangeRate, dispatch_uid="nnmware_rates_version")
+signals.post_delete.connect(exchange_rate_changed, sender=ExchangeRate, dispatch_uid="nnmware_rates_version")
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide cache of latest exchange rates.
+
+Latest official and commercial rate of every currency loaded by one
+query and kept in memory for MONEY_RATES_TTL seconds. parse_currency
+and changes of ExchangeRate bump version in shared cache, so other
+processes reload rates after next version check.
+"""
+import threading
+import time
+from datetime import date
+from django.conf import settings
+from django.core.cache import cache
+from nnmware.apps.money.models import ExchangeRate
+from nnmware.core.config import CURRENCY, OFFICIAL_RATE
+
+RATES_TTL = getattr(settings, 'MONEY_RATES_TTL', 300)
+RATES_VERSION_CHECK = getattr(settings, 'MONEY_RATES_VERSION_CHECK', 10)
+RATES_VERSION_KEY = 'nnmware_money_rates_version'
+RATES_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+LATEST_WHERE = """%(table)s.date = (SELECT MAX(r.date) FROM %(table)s r
+    WHERE r.currency_id = %(table)s.currency_id AND r.date <= %%s)"""
+
+
+class RateCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rates = None
+        self.version = None
+        self.loaded = 0
+        self.checked = 0
+
+    def _load(self):
+        rates = dict()
+        table = ExchangeRate._meta.db_table
+        for code, nominal, official_rate, rate in ExchangeRate.objects.filter(currency__isnull=False).extra(
+                where=[LATEST_WHERE % {'table': table}], params=[date.today()]).values_list(
+                'currency__code', 'nominal', 'official_rate', 'rate'):
+            rates[code] = (nominal, official_rate, rate)
+        return rates
+
+    def get_rates(self):
+        now = time.time()
+        with self.lock:
+            if self.rates is not None and now - self.checked > RATES_VERSION_CHECK:
+                self.checked = now
+                if cache.get(RATES_VERSION_KEY) != self.version:
+                    self.rates = None
+            if self.rates is None or now - self.loaded > RATES_TTL:
+                self.version = cache.get(RATES_VERSION_KEY)
+                self.rates = self._load()
+                self.loaded = self.checked = now
+            return self.rates
+
+    def clear(self):
+        with self.lock:
+            self.rates = None
+
+_rates = RateCache()
+
+def get_rate(code, official=None):
+    """
+    Returns (nominal, exchange) for currency code, KeyError if rate is unknown
+    """
+    nominal, official_rate, rate = _rates.get_rates()[code]
+    if official is None:
+        official = OFFICIAL_RATE
+    if official:
+        return nominal, official_rate
+    return nominal, rate
+
+def convert(amount, from_code, to_code, official=None):
+    """
+    Convert amount between currencies through default currency
+    """
+    if from_code == to_code:
+        return amount
+    if from_code != CURRENCY:
+        nominal, exchange = get_rate(from_code, official)
+        amount = (amount*exchange)/nominal
+    if to_code != CURRENCY:
+        nominal, exchange = get_rate(to_code, official)
+        amount = (amount*nominal)/exchange
+    return amount
+
+def bump_rates_version():
+    try:
+        cache.incr(RATES_VERSION_KEY)
+    except ValueError:
+        cache.set(RATES_VERSION_KEY, 1, RATES_VERSION_TIMEOUT)
+    _rates.clear()
@@ -1,21 +1,18 @@
+import csv
+import tempfile
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet, ValuesQuerySet
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
 from datetime import datetime, date, time
-from nnmware.apps.money.models import ExchangeRate, Currency
-from nnmware.core.config import OFFICIAL_RATE, CURRENCY
+from nnmware.apps.money.rates import convert
+from nnmware.core.config import CURRENCY
 
 def convert_from_client_currency(request, amount):
     try:
         if request.COOKIES['currency'] == CURRENCY:
             return amount
-        currency = Currency.objects.get(code=request.COOKIES['currency'])
-        rate = ExchangeRate.objects.filter(currency=currency).filter(date__lte=datetime.now()).order_by('-date')[0]
-        if OFFICIAL_RATE:
-            exchange = rate.official_rate
-        else:
-            exchange = rate.rate
-        return int((int(amount)*exchange)/rate.nominal)
+        return int(convert(int(amount), request.COOKIES['currency'], CURRENCY))
     except :
         return int(amount)
 
@@ -107,3 +104,114 @@ class ExcelResponse(HttpResponse):
                                             mimetype=mimetype)
         self['Content-Disposition'] = 'attachment;filename="%s.%s"' % \
             (output_name.replace('"', '\"'), file_ext)
+
+
+EXPORT_CHUNK = 2000
+EXPORT_FORMATS = ('csv', 'xlsx')
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def iterate_values(queryset, fields, chunk=EXPORT_CHUNK):
+    """
+    Yields tuples of fields for rows of queryset ordered by pk, not more
+    than chunk rows in memory
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(pk__gt=last)
+        rows = list(page.values_list('pk', *fields)[:chunk])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk:
+            break
+        last = rows[-1][0]
+
+def export_headers(model, fields):
+    headers = []
+    for name in fields:
+        try:
+            headers.append(unicode(model._meta.get_field(name).verbose_name))
+        except FieldDoesNotExist:
+            headers.append(name)
+    return headers
+
+
+class Echo(object):
+    # csv.writer write every row to stream, return it for generator instead
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value, encoding):
+    if value is None:
+        return ''
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return value.encode(encoding)
+
+def csv_stream(headers, rows, encoding='utf8'):
+    writer = csv.writer(Echo())
+    yield writer.writerow([_csv_value(h, encoding) for h in headers])
+    for row in rows:
+        yield writer.writerow([_csv_value(v, encoding) for v in row])
+
+def xlsx_file(headers, rows):
+    """
+    Write rows to temporary xlsx file, worksheet rows flushed to disk one
+    by one. ImportError if xlsxwriter is not installed.
+    """
+    import xlsxwriter
+    output = tempfile.TemporaryFile()
+    book = xlsxwriter.Workbook(output, {'constant_memory': True})
+    sheet = book.add_worksheet()
+    formats = {datetime: book.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'}),
+               date: book.add_format({'num_format': 'yyyy-mm-dd'}),
+               time: book.add_format({'num_format': 'hh:mm:ss'})}
+    sheet.write_row(0, 0, headers)
+    for rowx, row in enumerate(rows):
+        for colx, value in enumerate(row):
+            if value is None:
+                continue
+            if type(value) in formats:
+                sheet.write_datetime(rowx + 1, colx, value, formats[type(value)])
+            else:
+                sheet.write(rowx + 1, colx, value)
+    book.close()
+    output.seek(0)
+    return output
+
+def stream_file(f, chunk=64 * 1024):
+    try:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+def export_response(queryset, fields, headers=None, output_name='export', export_format='csv'):
+    """
+    StreamingHttpResponse with values of fields for every row of queryset.
+    xlsx built in temporary file, without xlsxwriter csv is returned.
+    """
+    if headers is None:
+        headers = export_headers(queryset.model, fields)
+    rows = iterate_values(queryset, fields)
+    response = None
+    if export_format == 'xlsx':
+        try:
+            response = StreamingHttpResponse(stream_file(xlsx_file(headers, rows)), content_type=XLSX_MIMETYPE)
+            file_ext = 'xlsx'
+        except ImportError:
+            pass
+    if response is None:
+        response = StreamingHttpResponse(csv_stream(headers, rows), content_type='text/csv')
+        file_ext = 'csv'
+    response['Content-Disposition'] = 'attachment;filename="%s.%s"' % \
+        (output_name.replace('"', '\"'), file_ext)
+    return response
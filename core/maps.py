@@ -12,16 +12,24 @@ from contextlib import closing
 import httplib
 import json
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Geocoder(object):
     base_url = "http://nominatim.openstreetmap.org/search?format=json&polygon=1&addressdetails=1&%s"
 
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+
     def geocode(self, q):
 
         params = { 'q': q.encode('utf-8') }
 
         url = self.base_url % urllib.urlencode(params)
         try:
-            data = urllib2.urlopen(url)
+            data = urllib2.urlopen(url, timeout=self.timeout)
             response = data.read()
             return self.parse_json(response)
         except :
@@ -127,11 +135,63 @@ def distance_to_object(origin, destiny):
     return RADIUS*c
 
 
+def distances_from(origin, latitudes, longitudes):
+    """
+    Distances in km from origin (latitude, longitude) to every point
+    """
+    if numpy is not None:
+        latitude1 = radians(origin[0])
+        latitude2 = numpy.radians(numpy.asarray(latitudes, dtype=float))
+        dLat = latitude2 - latitude1
+        dLong = numpy.radians(numpy.asarray(longitudes, dtype=float)) - radians(origin[1])
+        a = numpy.sin(dLat/2)**2 + cos(latitude1)*numpy.cos(latitude2)*numpy.sin(dLong/2)**2
+        return (RADIUS*2*numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))).tolist()
+    return [distance(origin, (latitude, longitude)) for latitude, longitude in zip(latitudes, longitudes)]
+
+def distance_matrix(origins, points):
+    """
+    Distances in km between every origin and every point, both are lists
+    of (latitude, longitude). Returns list of rows, one row for origin.
+    """
+    if not origins or not points:
+        return [[] for origin in origins]
+    if numpy is not None:
+        origins = numpy.radians(numpy.asarray(origins, dtype=float))
+        points = numpy.radians(numpy.asarray(points, dtype=float))
+        latitude1 = origins[:, 0][:, numpy.newaxis]
+        latitude2 = points[:, 0][numpy.newaxis, :]
+        dLat = latitude2 - latitude1
+        dLong = points[:, 1][numpy.newaxis, :] - origins[:, 1][:, numpy.newaxis]
+        a = numpy.sin(dLat/2)**2 + numpy.cos(latitude1)*numpy.cos(latitude2)*numpy.sin(dLong/2)**2
+        return (RADIUS*2*numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))).tolist()
+    latitudes = [p[0] for p in points]
+    longitudes = [p[1] for p in points]
+    return [distances_from(origin, latitudes, longitudes) for origin in origins]
+
+def nearest_k(origin, latitudes, longitudes, k):
+    """
+    Returns [(index of point, distance in km), ...] for k nearest points, nearest first
+    """
+    distances = distances_from(origin, latitudes, longitudes)
+    if numpy is not None and k < len(distances):
+        values = numpy.asarray(distances)
+        nearest = numpy.argpartition(values, k)[:k]
+        return sorted([(int(i), distances[i]) for i in nearest], key=lambda x: x[1])
+    return sorted(enumerate(distances), key=lambda x: x[1])[:k]
+
+def distance_map(origin, objects):
+    """
+    Returns {pk: distance in km} from origin to every object, all have latitude and longitude
+    """
+    objects = list(objects)
+    distances = distances_from((origin.latitude, origin.longitude), [o.latitude for o in objects],
+        [o.longitude for o in objects])
+    return dict([(o.pk, d) for o, d in zip(objects, distances)])
+
 def places_near_object(origin, radius, model_db_name):
-    query= """SELECT id, 3956 * 2 * ASIN(SQRT(POWER(SIN((%s - latitude) *
+    query= """SELECT id, distance FROM (SELECT id, 3956 * 2 * ASIN(SQRT(POWER(SIN((%s - latitude) *
         0.0174532925 / 2), 2) + COS(%s * 0.0174532925) * COS(latitude * 0.0174532925) *
-        POWER(SIN((%s - longitude) * 0.0174532925 / 2), 2) )) as distance from %s
-        having distance < %s ORDER BY distance ASC """ % ( origin.latitude, origin.latitude,
+        POWER(SIN((%s - longitude) * 0.0174532925 / 2), 2) )) as distance from %s) places
+        WHERE distance < %s ORDER BY distance ASC """ % ( origin.latitude, origin.latitude,
                     origin.longitude, model_db_name, radius)
     return query
-
@@ -7,45 +7,56 @@ from django.template.defaultfilters import stringfilter
 from django.utils.translation import ugettext_lazy as _
 from nnmware.apps.address.models import City
 from nnmware.apps.booking.models import Hotel, TWO_STAR, THREE_STAR, FOUR_STAR, FIVE_STAR, \
-    HotelOption, MINI_HOTEL, PlacePrice, Availability, HOSTEL, Discount
-from nnmware.apps.money.models import ExchangeRate, Currency
-from nnmware.core.config import OFFICIAL_RATE, CURRENCY
+    HotelOption, MINI_HOTEL, PlacePrice, HOSTEL
+from nnmware.apps.booking.quote import stay_quote
+from nnmware.apps.money.rates import convert
+from nnmware.core.config import CURRENCY
 from nnmware.core.maps import distance_to_object
 from nnmware.core.models import VisitorHit
-from nnmware.core.utils import convert_to_date, daterange
+from nnmware.core.utils import convert_to_date
 
 
 register = Library()
 
+def star_count(starcount, city=None):
+    hotels = Hotel.objects.filter(starcount=starcount)
+    if city:
+        hotels = hotels.filter(city=city)
+    return hotels.count()
+
 @register.assignment_tag
 def minihotel_count(city=None):
-    result = Hotel.objects.filter(starcount=MINI_HOTEL).count()
-    return result
+    return star_count(MINI_HOTEL, city)
 
 @register.assignment_tag
 def hostel_count(city=None):
-    result = Hotel.objects.filter(starcount=HOSTEL).count()
-    return result
+    return star_count(HOSTEL, city)
 
 @register.assignment_tag
 def two_star_count(city=None):
-    result = Hotel.objects.filter(starcount=TWO_STAR).count()
-    return result
+    return star_count(TWO_STAR, city)
 
 @register.assignment_tag
 def three_star_count(city=None):
-    result = Hotel.objects.filter(starcount=THREE_STAR).count()
-    return result
+    return star_count(THREE_STAR, city)
 
 @register.assignment_tag
 def four_star_count(city=None):
-    result = Hotel.objects.filter(starcount=FOUR_STAR).count()
-    return result
+    return star_count(FOUR_STAR, city)
 
 @register.assignment_tag
 def five_star_count(city=None):
-    result = Hotel.objects.filter(starcount=FIVE_STAR).count()
-    return result
+    return star_count(FIVE_STAR, city)
+
+@register.simple_tag
+def facet_count(facets, name, key):
+    """
+    Count of hotels in facet of HotelList, name is 'stars' or 'options'
+    """
+    try:
+        return facets[name].get(int(key), 0)
+    except (KeyError, TypeError, ValueError):
+        return 0
 
 @register.assignment_tag
 def search_sticky_options():
@@ -157,45 +168,33 @@ def client_days_booking(context):
     delta = (to_date - from_date).days
     return int(delta)
 
-@register.simple_tag(takes_context = True)
-def room_price_average(context, room):
+def search_quote(context, room):
     request = context['request']
     search_data = context['search_data']
-    f_date = search_data['from_date']
-    t_date = search_data['to_date']
-    guests = search_data['guests']
-    from_date = convert_to_date(f_date)
-    to_date = convert_to_date(t_date)
-    delta = (to_date - from_date).days
-    room_all_amount = 0
-    for single_date in daterange(from_date, to_date):
-        room_all_amount += room.amount_on_date_guest_variant(single_date, guests)[0]
-    result = room_all_amount/delta
-    return amount_request_currency(request, result)
+    from_date = convert_to_date(search_data['from_date'])
+    to_date = convert_to_date(search_data['to_date'])
+    return stay_quote(request, room, from_date, to_date, search_data['guests'])
+
+@register.simple_tag(takes_context = True)
+def room_price_average(context, room):
+    quote = search_quote(context, room)
+    if quote is None:
+        return ''
+    return amount_request_currency(context['request'], quote.average)
 
 @register.simple_tag(takes_context = True)
 def room_full_amount(context, room):
-    request = context['request']
-    search_data = context['search_data']
-    f_date = search_data['from_date']
-    t_date = search_data['to_date']
-    guests = search_data['guests']
-    from_date = convert_to_date(f_date)
-    to_date = convert_to_date(t_date)
-    delta = (to_date - from_date).days
-    room_all_amount = 0
-    for single_date in daterange(from_date, to_date):
-        room_all_amount += room.amount_on_date_guest_variant(single_date, guests)[0]
-    result = room_all_amount
-    return amount_request_currency(request, result)
+    quote = search_quote(context, room)
+    if quote is None:
+        return ''
+    return amount_request_currency(context['request'], quote.total)
 
 @register.simple_tag(takes_context = True)
 def room_variant(context, room):
-    search_data = context['search_data']
-    f_date = search_data['from_date']
-    guests = search_data['guests']
-    from_date = convert_to_date(f_date)
-    return room.amount_on_date_guest_variant(from_date, guests)[1]
+    quote = search_quote(context, room)
+    if quote is None:
+        return ''
+    return quote.settlement
 
 @register.simple_tag(takes_context = True)
 def client_currency(context):
@@ -222,20 +221,21 @@ def convert_to_client_currency(context, amount):
 
 def amount_request_currency(request, amount):
     try:
-        currency = Currency.objects.get(code=request.COOKIES['currency'])
-        rate = ExchangeRate.objects.filter(currency=currency).filter(date__lte=datetime.now()).order_by('-date')[0]
-        if OFFICIAL_RATE:
-            exchange = rate.official_rate
-        else:
-            exchange = rate.rate
-        return int((amount*rate.nominal)/exchange)
+        return int(convert(amount, CURRENCY, request.COOKIES['currency']))
     except :
         return int(amount)
 
 
-@register.simple_tag
-def distance_for(origin, destiny):
-    result = distance_to_object(origin,destiny)
+@register.simple_tag(takes_context=True)
+def distance_for(context, origin, destiny):
+    # Distances from object of page calculated by view in one batch
+    distances = context.get('distances')
+    page_object = context.get('object')
+    if distances is not None and page_object is not None and origin.pk == page_object.pk \
+            and destiny.pk in distances:
+        result = distances[destiny.pk]
+    else:
+        result = distance_to_object(origin,destiny)
     return format(result, '.2f')
 
 @register.filter(is_safe=True)
@@ -269,30 +269,6 @@ def hotels_moscow_count():
     result = Hotel.objects.filter(city=city).count()
     return result
 
-@register.simple_tag
-def settlement_price_on_date(settlement,date):
-    try:
-        result = int(PlacePrice.objects.get(settlement=settlement,date=date).amount)
-    except :
-        result = ''
-    return result
-
-@register.simple_tag
-def discount_on_date(room,date):
-    try:
-        result = int(Discount.objects.get(room=room,date=date).discount)
-    except :
-        result = ''
-    return result
-
-@register.simple_tag
-def room_availability_on_date(room,date):
-    try:
-        result = Availability.objects.get(room=room,date=date).placecount
-    except :
-        result = ''
-    return result
-
 @register.simple_tag
 def today_visitor_count():
     result = set(VisitorHit.objects.values_list('session_key', flat=True))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import sys
+import time
+from django.test import SimpleTestCase
+from django.utils.unittest import skipUnless
+from nnmware.core import maps
+from nnmware.core.maps import distance, distances_from, distance_matrix, nearest_k
+
+
+def random_points(count, seed=1):
+    rnd = random.Random(seed)
+    return [(rnd.uniform(-89.9, 89.9), rnd.uniform(-180, 180)) for i in range(count)]
+
+
+class DistanceTest(SimpleTestCase):
+
+    def setUp(self):
+        self.origin = (59.93, 30.31)
+        self.points = random_points(500) + [self.origin, (-59.93, -149.69), (59.93, 30.32)]
+        self.latitudes = [p[0] for p in self.points]
+        self.longitudes = [p[1] for p in self.points]
+
+    def test_distances_from_same_as_distance(self):
+        for value, point in zip(distances_from(self.origin, self.latitudes, self.longitudes), self.points):
+            self.assertAlmostEqual(value, distance(self.origin, point), places=6)
+
+    def test_distance_matrix_same_as_distance(self):
+        origins = random_points(7, seed=2)
+        matrix = distance_matrix(origins, self.points)
+        self.assertEqual(len(matrix), len(origins))
+        for origin, row in zip(origins, matrix):
+            self.assertEqual(len(row), len(self.points))
+            for value, point in zip(row, self.points):
+                self.assertAlmostEqual(value, distance(origin, point), places=6)
+
+    def test_empty(self):
+        self.assertEqual(distances_from(self.origin, [], []), [])
+        self.assertEqual(distance_matrix([self.origin], []), [[]])
+        self.assertEqual(distance_matrix([], self.points), [])
+        self.assertEqual(nearest_k(self.origin, [], [], 3), [])
+
+    def test_nearest_k(self):
+        expected = sorted([(distance(self.origin, p), i) for i, p in enumerate(self.points)])
+        for k in (1, 5, 50, len(self.points), len(self.points) + 10):
+            result = nearest_k(self.origin, self.latitudes, self.longitudes, k)
+            self.assertEqual([i for i, d in result], [i for d, i in expected[:k]])
+            for (i, value), (d, j) in zip(result, expected):
+                self.assertAlmostEqual(value, d, places=6)
+
+
+BENCHMARK_POINTS = int(os.environ.get('NNMWARE_BENCHMARK_POINTS', 0))
+
+
+class DistanceBenchmark(SimpleTestCase):
+    """
+    Run with NNMWARE_BENCHMARK_POINTS=100000 to compare distance() with distances_from()
+    """
+
+    @skipUnless(BENCHMARK_POINTS, 'Set NNMWARE_BENCHMARK_POINTS to run benchmark')
+    def test_batch_against_scalar(self):
+        origin = (59.93, 30.31)
+        points = random_points(BENCHMARK_POINTS, seed=3)
+        latitudes = [p[0] for p in points]
+        longitudes = [p[1] for p in points]
+        started = time.time()
+        scalar = [distance(origin, p) for p in points]
+        scalar_time = time.time() - started
+        started = time.time()
+        batch = distances_from(origin, latitudes, longitudes)
+        batch_time = time.time() - started
+        sys.stderr.write('\n%s points: distance() %.3f s, distances_from() %.3f s%s\n' % (
+            BENCHMARK_POINTS, scalar_time, batch_time, '' if maps.numpy is not None else ' without numpy'))
+        self.assertEqual(len(batch), BENCHMARK_POINTS)
+        for i in range(0, BENCHMARK_POINTS, 997):
+            self.assertAlmostEqual(batch[i], scalar[i], places=6)
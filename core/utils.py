@@ -1,5 +1,6 @@
 import hashlib
 import re
+from contextlib import contextmanager
 import unicodedata
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 import logging
@@ -9,9 +10,9 @@ import sys
 import types
 from datetime import datetime, date, timedelta
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage
 
-from django.db import models
+from django.db import models, transaction
 from django.template.loader import render_to_string
 from django.utils.encoding import smart_unicode
 from nnmware.core import oembed
@@ -321,13 +322,35 @@ def daterange(start_date, end_date):
         yield start_date + timedelta(n)
 
 def send_template_mail(subject,body,mail_dict, recipients):
+    return template_mail_message(subject, body, mail_dict, recipients).send()
+
+def template_mail_message(subject, body, mail_dict, recipients):
+    # Message of send_template_mail, can be sent later, many in one connection
     subject = render_to_string(subject, mail_dict)
     subject = ''.join(subject.splitlines())
     body = render_to_string(body, mail_dict)
-    send_mail(subject=subject, message=body, from_email=settings.EMAIL_HOST_USER,
-        recipient_list=recipients)
+    return EmailMessage(subject=subject, body=body, from_email=settings.EMAIL_HOST_USER,
+        to=recipients)
 
 def setting(name, default=None):
     """Return setting value for given name or default value."""
     return getattr(settings, name, default)
 
+
+@contextmanager
+def commit_on_success_unless_managed(using=None):
+    """
+    commit_on_success which don't commit transaction of caller, block in
+    managed transaction is under savepoint and rolled back alone on error
+    """
+    if not transaction.is_managed(using=using):
+        with transaction.commit_on_success(using=using):
+            yield
+        return
+    sid = transaction.savepoint(using=using)
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid, using=using)
+        raise
+    transaction.savepoint_commit(sid, using=using)
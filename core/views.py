@@ -18,6 +18,7 @@ from django.views.generic.edit import CreateView, UpdateView, BaseFormView, Form
 from django.views.generic.list import ListView
 from django.utils.translation import ugettext_lazy as _
 from nnmware.core.decorators import ssl_required, ssl_not_required
+from nnmware.core.financial import export_response, EXPORT_FORMATS
 from nnmware.core.ajax import as_json, AjaxLazyAnswer
 from nnmware.core.http import redirect
 from nnmware.core.imgutil import remove_thumbnails
@@ -396,6 +397,22 @@ class CurrentUserAuthenticated(object):
         return super(CurrentUserAuthenticated, self).dispatch(request, *args, **kwargs)
 
 
+class ExportMixin(object):
+    """ List view which return rows of queryset as csv or xlsx file with ?export=<format> """
+    export_fields = ()
+    export_name = 'export'
+
+    def get_export_queryset(self):
+        return self.get_queryset()
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('export')
+        if export_format in EXPORT_FORMATS and self.export_fields:
+            return export_response(self.get_export_queryset(), self.export_fields,
+                output_name=self.export_name, export_format=export_format)
+        return super(ExportMixin, self).get(request, *args, **kwargs)
+
+
 class CurrentUserSuperuser(object):
     """ Generic object for view that check superuser rights for current user """
 